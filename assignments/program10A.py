@@ -12,13 +12,13 @@ from math import sqrt, pi
 
 # reuse previous programs
 from program1A import mean
-from program5A import simpson_rule_integrate, gamma
+from program5A import simpson_rule_integrate, student_t_constant
 
 
 def double_sided_student_t_probability(t, n):
     "Calculate the p-value using a double sided student t distribution"
     # create the function for n degrees of freedom:
-    k = gamma(n + 1, 2) / (sqrt(n * pi) * gamma(n, 2))
+    k = student_t_constant(n)
     f_t_dist = lambda u: k * (1 + (u ** 2) / float(n)) ** (- (n + 1) / 2.0)
     # integrate a finite area from the origin to t
     p_aux = simpson_rule_integrate(f_t_dist, 0, t)
@@ -7,77 +7,99 @@ __author__ = "Mariano Reingart (reingart@gmail.com)"
 __copyright__ = "Copyright (C) 2011 Mariano Reingart"
 __license__ = "GPL 3.0"
 
+import os
+import sys
 from math import e, pi, sqrt
 
+# gamma and the (memoized) t distribution constant are shared with the psp2py
+# statistics: this program depends on ../psp2py/modules/integration.py
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                             "..", "psp2py", "modules"))
+from integration import gamma, student_t_constant
 
-def compute_integral(f, x_low, x_high, w, n):
-    "Compute the numerical approximation of a definite integral"
-    # composite simpson rule (w and n are the subintervals width and quantity)
-    term1 = f(x_low)
-    term2 = 0
-    for j in xrange(1, n, 2):
-        term2 += f(x_low + j * w)
-    term3 = 0
-    for j in xrange(2, n, 2):
-        term3 += f(x_low + j * w)
-    term4 = f(x_high)
-    y = w / 3.0 * (term1 + 4 * term2 + 2 * term3 + term4)
 
-    return y
+def normalize_limits(x_low, x_high):
+    "Correct the integration range for symmetrical normalized functions"
+    # returns the new limits and the area to add (p >= 0) or subtract (p < 0)
+    if x_high < 0 and x_low == float("-infinity"):
+        return 0, abs(x_high), -0.5
+    elif x_low == float("-infinity"):
+        return 0, x_high, 0.5
+    elif x_low > 0 and x_high == float("infinity"):
+        return 0, x_low, -0.5
+    return x_low, x_high, 0
+
+
+def sum_samples(f, x_low, w, first, n, step=2):
+    "Sum f(x_low + j * w) for j in range(first, n, step)"
+    total = 0
+    for j in xrange(first, n, step):
+        total += f(x_low + j * w)
+    return total
 
 
 def simpson_rule_integrate(f, x_low, x_high, error=0.00001):
     "Integrate complex funtins within finite limits"
     # 1. identify the upper and lower limits of the numerical integration
-    # correct integration range for symmetrical normalized functions:
-    if x_high < 0 and x_low == float("-infinity"):
-        x_high = abs(x_high)
-        x_low = 0
-        p = -0.5
-    elif x_low == float("-infinity"):
-        x_low = 0
-        p = 0.5
-    elif x_low > 0 and x_high == float("infinity"):
-        x_high = x_low
-        x_low = 0
-        p = -0.5
-    else:
-        p = 0
+    x_low, x_high, p = normalize_limits(x_low, x_high)
     # 2. select an initial number N and old result
     n = 20
     old_y = 0
-    while True:
-        # 3. divide the range to get the segment width
-        w = (x_high - x_low) / n
-        # 4. compute the numerical integration approximation
-        y = compute_integral(f, x_low, x_high, w, n)
-        # 5. compare with the old result if error is permisible
-        if abs(y - old_y) <= error:
-            if p >= 0:
-                return p + y
-            else:
-                return - p - y
+    # 3. divide the range to get the segment width
+    w = (x_high - x_low) / float(n)
+    # 4. compute the numerical integration approximation (keeping the sums)
+    ends = f(x_low) + f(x_high)
+    odd = sum_samples(f, x_low, w, 1, n)        # weight 4
+    even = sum_samples(f, x_low, w, 2, n)       # weight 2
+    y = w / 3.0 * (ends + 4 * odd + 2 * even)
+    # 5. compare with the old result if error is permisible
+    while abs(y - old_y) > error:
         old_y = y
-        # 6. double N
+        # 6. double N: the previous points are the even ones now, so only
+        #    the new midpoints (odd) have to be evaluated
+        even += odd
         n = 2 * n
+        w = w / 2
+        odd = sum_samples(f, x_low, w, 1, n)
+        y = w / 3.0 * (ends + 4 * odd + 2 * even)
         # 7. repeat ...
-
-
-def factorial(x, step=1):
-    "Calculate integer or float factorial (for gamma function, step=2)"
-    if x > step:
-        return x * factorial(x - step, step) / step
-    return x / step
-
-
-def gamma(n, d=2):
-    "Calculate gamma function value for a fraction (numerator & denominator)"
-    # WARNING: only tested for d=2 !
-    if n % 2 != 0 and d == 2:
-        return factorial(n - 2, step=2.0) * sqrt(pi)
+    if p >= 0:
+        return p + y
     else:
-        i = n / d
-        return factorial(i - 1)
+        return - p - y
+
+
+def adaptive_simpson_integrate(f, x_low, x_high, error=0.00001, 
+                               max_depth=50):
+    "Integrate refining only the subintervals that don't meet their error"
+    x_low, x_high, p = normalize_limits(x_low, x_high)
+    f_low, f_high = f(x_low), f(x_high)
+    x_mid = (x_low + x_high) / 2.0
+    f_mid = f(x_mid)
+    whole = (x_high - x_low) / 6.0 * (f_low + 4 * f_mid + f_high)
+    y = adaptive_simpson_step(f, x_low, x_high, f_low, f_mid, f_high, whole, 
+                              error, max_depth)
+    if p >= 0:
+        return p + y
+    else:
+        return - p - y
+
+
+def adaptive_simpson_step(f, a, b, fa, fm, fb, whole, error, depth):
+    "Recursive step: split [a, b] and check the error budget of each half"
+    m = (a + b) / 2.0
+    lm, rm = (a + m) / 2.0, (m + b) / 2.0
+    flm, frm = f(lm), f(rm)
+    left = (m - a) / 6.0 * (fa + 4 * flm + fm)
+    right = (b - m) / 6.0 * (fm + 4 * frm + fb)
+    delta = left + right - whole
+    if depth <= 0 or abs(delta) <= 15 * error:
+        return left + right + delta / 15.0     # richardson extrapolation
+    # each half has to meet half of the error budget:
+    return (adaptive_simpson_step(f, a, m, fa, flm, fm, left, error / 2.0, 
+                                  depth - 1) + 
+            adaptive_simpson_step(f, m, b, fm, frm, fb, right, error / 2.0, 
+                                  depth - 1))
 
 
 def simpson_rule_tests():
@@ -96,7 +118,8 @@ def simpson_rule_tests():
     # student t distribution
     n = 9   # degrees of freedom
     assert round(gamma(n, 2), 4) == 11.6317
-    k = gamma(n + 1, 2) / (sqrt(n*pi) * gamma(n, 2))
+    k = student_t_constant(n)
+    assert round(k - gamma(n + 1, 2) / (sqrt(n*pi) * gamma(n, 2)), 12) == 0
     f_t_dist = lambda u: k * (1 + (u ** 2) / float(n)) ** (- (n +1) / 2.0)
     # WARNING: the Table A17 on [HUMPHREY95] pp.524 seems to be wrong...
     assert round(f_t_dist(0), 4) == 0.3880
@@ -107,7 +130,7 @@ def simpson_rule_tests():
     assert round(p, 4) == 0.8501
 
     n = 4   # degrees of freedom
-    k = gamma(n + 1, 2) / (sqrt(n*pi) * gamma(n, 2))
+    k = student_t_constant(n)
     f_t_dist = lambda u: k * (1 + (u ** 2) / float(n)) ** (- (n +1) / 2.0)
     p = simpson_rule_integrate(f_t_dist, - inf, 3.747)
     assert round(p, 4) == 0.99
@@ -115,6 +138,12 @@ def simpson_rule_tests():
     p = simpson_rule_integrate(f_t_dist, 2.132, inf)
     assert round(p, 4) == 0.05
 
+    # adaptive simpson (only refine where it is needed)
+    p = adaptive_simpson_integrate(f_normal_dist, - inf, 2.5)
+    assert round(p, 4) == 0.9938
+    p = adaptive_simpson_integrate(f_t_dist, - inf, 3.747)
+    assert round(p, 4) == 0.99
+
 
 if __name__ == "__main__":
     simpson_rule_tests()
@@ -8,13 +8,20 @@ __copyright__ = "Copyright (C) 2014 Mariano Reingart"
 __license__ = "GPL 3.0"
 
 
+import logging
 import os
 import sqlite3
+import time
 import UserDict
+import weakref
 
 
-DEBUG = True
+DEBUG = False                   # collect statistics (calls & time per query)
 SQL_TYPE_MAP = {int: "INTEGER", float: "REAL", str: "TEXT", bool: "BOOLEAN"}
+AGGREGATE_TYPES = {sum: 'sum', len: 'count', min: 'min', max: 'max'}
+FLUSH_THRESHOLD = 100           # modified rows to force a write-behind flush
+
+logger = logging.getLogger(__name__)
 
 
 class Database():
@@ -25,6 +32,9 @@ class Database():
         self.cnn.row_factory = sqlite3.Row
         self.primary_keys = {}
         self.cur = None
+        self.statements = {}        # compiled SQL cache (table & fields)
+        self.stats = {}             # SQL: [number of calls, total time]
+        self.trace = None           # hook called with sql, values, elapsed
     
     def cursor(self, force=False):
         "Instantiate a new (if needed) cursor to execute SQL queries"
@@ -68,74 +78,129 @@ class Database():
         sql = '\n'.join(sql)
         cur.execute(sql)
 
+    def execute(self, sql, values, cur=None, many=False):
+        "Run a SQL statement (logging and timing it), return the cursor"
+        if cur is None:
+            cur = self.cursor()
+        execute = cur.executemany if many else cur.execute
+        if DEBUG or self.trace:
+            start = time.time()
+            execute(sql, values)
+            elapsed = time.time() - start
+            stat = self.stats.get(sql)
+            if stat:
+                stat[0] += 1
+                stat[1] += elapsed
+            else:
+                self.stats[sql] = [1, elapsed]
+            if self.trace:
+                self.trace(sql, values, elapsed)
+        else:
+            execute(sql, values)
+        logger.debug("%s %s", sql, values)
+        return cur
+
     def insert(self, table, **kwargs):
         "Insert a row for the given values in the specified table"
-        items = kwargs.items()
-        fields = ', '.join([k for k, v in items])
-        placemarks = ', '.join(['?' for k, v in items])
-        sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, fields, placemarks)
-        cur = self.cnn.cursor()
-        if DEBUG: print sql, [v for k, v in items]
-        cur.execute(sql, [v for k, v in items])
+        fields = tuple(sorted(kwargs))
+        key = "insert", table, fields
+        sql = self.statements.get(key)
+        if sql is None:
+            placemarks = ', '.join(['?' for k in fields])
+            sql = "INSERT INTO %s (%s) VALUES (%s)" % (table, 
+                                                ', '.join(fields), placemarks)
+            self.statements[key] = sql
+        cur = self.execute(sql, [kwargs[k] for k in fields], self.cnn.cursor())
         return cur.lastrowid
 
     def update(self, table, **kwargs):
         "Update rows using the given values (filter by primary key)"
-        items = kwargs.items()
         pk = table + "_id"
-        placemarks = ', '.join(["%s=?" % k for k, v in items if k != pk])
-        values = [v for k, v in items if k != pk] + [kwargs[pk]]
-        sql = "UPDATE %s SET %s WHERE %s = ?" % (table, placemarks, pk)
-        cur = self.cursor()
-        if DEBUG: print sql, values
-        cur.execute(sql, values)
-        return cur.rowcount
+        fields = tuple(sorted([k for k in kwargs if k != pk]))
+        key = "update", table, fields
+        sql = self.statements.get(key)
+        if sql is None:
+            placemarks = ', '.join(["%s=?" % k for k in fields])
+            sql = "UPDATE %s SET %s WHERE %s = ?" % (table, placemarks, pk)
+            self.statements[key] = sql
+        values = [kwargs[k] for k in fields] + [kwargs[pk]]
+        return self.execute(sql, values).rowcount
+
+    def update_many(self, table, fields, values):
+        "Update several rows at once (values: fields and primary key lists)"
+        pk = table + "_id"
+        key = "update", table, tuple(fields)
+        sql = self.statements.get(key)
+        if sql is None:
+            placemarks = ', '.join(["%s=?" % k for k in fields])
+            sql = "UPDATE %s SET %s WHERE %s = ?" % (table, placemarks, pk)
+            self.statements[key] = sql
+        return self.execute(sql, values, many=True).rowcount
+
+    def delete_many(self, table, ids):
+        "Delete several rows at once (filter by primary key)"
+        pk = table + "_id"
+        key = "delete", table, (pk, )
+        sql = self.statements.get(key)
+        if sql is None:
+            sql = "DELETE FROM %s WHERE %s=?" % (table, pk)
+            self.statements[key] = sql
+        return self.execute(sql, [(i, ) for i in ids], many=True).rowcount
 
     def delete(self, table, **kwargs):
         "Delete rows (filter by given values)"
-        items = kwargs.items()
-        placemarks = ' AND '.join(["%s=?" % k for k, v in items])
-        values = [v for k, v in items]
-        sql = "DELETE FROM %s WHERE %s" % (table, placemarks)
-        cur = self.cursor()
-        if DEBUG: print sql, values
-        cur.execute(sql, values)
-        return cur.rowcount
+        fields = tuple(sorted(kwargs))
+        key = "delete", table, fields
+        sql = self.statements.get(key)
+        if sql is None:
+            placemarks = ' AND '.join(["%s=?" % k for k in fields])
+            sql = "DELETE FROM %s WHERE %s" % (table, placemarks)
+            self.statements[key] = sql
+        return self.execute(sql, [kwargs[k] for k in fields]).rowcount
 
     def select(self, table, **kwargs):
         "Query rows (filter by given values)"
-        items = kwargs.items()
+        items = sorted(kwargs.items())
         basic_types = tuple(SQL_TYPE_MAP.keys())
-        aggregate_types = {sum: 'sum', len: 'count', min: 'min', max: 'max'}
-        all_types = basic_types + tuple(aggregate_types.keys())
+        all_types = basic_types + tuple(AGGREGATE_TYPES.keys())
+        # fields are selected by type, filters differ if they are NULL:
+        signature = tuple([(k, v if v in all_types else v is None) 
+                           for k, v in items])
+        values = [v for k, v in items if v not in all_types]
+        key = "select", table, signature
+        sql = self.statements.get(key)
+        if sql is None:
+            sql = self.build_select(table, items, basic_types, all_types)
+            self.statements[key] = sql
+        return self.execute(sql, values).fetchall()
+
+    def build_select(self, table, items, basic_types, all_types):
+        "Generate the SELECT statement (fields, filters and aggregates)"
         where = ' AND '.join(["%s %s ?" % (k, "=" if v is not None else " is ") 
                               for k, v in items if v not in all_types])
         fields = ', '.join([(k if v in basic_types 
-                               else "%s(%s)" % (aggregate_types[v], k))
+                               else "%s(%s)" % (AGGREGATE_TYPES[v], k))
                             for k, v in items 
                             if v in all_types]) or "*"
-        if [v for k, v in items if v in aggregate_types]:
+        if [v for k, v in items if v in AGGREGATE_TYPES]:
             group_by = ', '.join([k for k, v in items 
-                                    if not v in (aggregate_types.keys())])
+                                    if not v in (AGGREGATE_TYPES.keys())])
         else:
             group_by = None
-        values = [v for k, v in items if v not in all_types]
         sql = "SELECT %s FROM %s" % (fields, table)
         if where:
             sql += " WHERE %s" % where
         if group_by and fields != "*":
             sql += " GROUP BY %s" % group_by
-        cur = self.cursor()
-        if DEBUG: print sql, values
-        cur.execute(sql, values)
-        return cur.fetchall()
+        return sql
 
     def __getitem__(self, table_name):
         "Return an intermediate accesor to the table (don't query the db yet)" 
         return Table(self, table_name)
 
     def __del__(self):
-        if DEBUG: print "Delayed COMMIT!"
+        if logger:                  # module could be unloaded on exit
+            logger.debug("Delayed COMMIT!")
         self.commit()
 
     def close(self):
@@ -190,6 +255,7 @@ class Row():
     "Dict-like to map stored fields in the database" 
     
     autocommit = True
+    shelf = None            # weak reference to notify modifications
     
     def __init__(self, db, table_name, primary_key=None, query=None):
         self.db = db
@@ -249,6 +315,14 @@ class Row():
         for k, v in other.items():
             if not k in self.data_in or self.data_in[k] != v:
                 self.data_out[k] = v
+        if self.data_out:
+            self.modified()
+
+    def modified(self):
+        "Notify the shelf that this record should be written back"
+        shelf = self.shelf and self.shelf()
+        if shelf is not None:
+            shelf.dirty[id(self)] = self
 
     def get(self, field, default=None):
         try:
@@ -277,6 +351,7 @@ class Row():
         if not self.primary_key and self.query:
             self.load()
         self.data_out[field] = value
+        self.modified()
 
     def __delitem__(self, field):
         "Remove the field from the internal cache"
@@ -287,7 +362,7 @@ class Row():
         # Note that this could not be immediate!
         # Also, exceptions here could be ignored by Python!
         if self.data_out and self.autocommit:
-            print "Autocommit!", self
+            logger.debug("Autocommit! %s", self)
             self.save()
 
     def __nonzero__(self):
@@ -308,24 +383,36 @@ class DictShelf(UserDict.DictMixin):
     "Database shelve replacement implementation (dictionary-like object)"
     
     def __init__(self, db, table_name, key_field_name, autocommit=True, 
-                       **filters):
+                       delay=0, threshold=FLUSH_THRESHOLD, **filters):
         self.db = db
         self.table_name = table_name
         self.key_field_name = key_field_name
         self.filters = filters
         self.deleted = []
+        self.dirty = {}             # modified rows (id: row) to be written
         self.autocommit = autocommit
+        # durability: seconds that changes could be kept in memory on sync
+        # (0 writes through, None only on flush) or max number of rows
+        self.delay = delay
+        self.threshold = threshold
+        self.last_flush = time.time()
         self.query()
     
     def query(self):
         self.dict = {}
         # populate the internal dictionary:
         for r in self.db.select(self.table_name, **self.filters):
-            row = Row(self.db, self.table_name)
-            row.autocommit = self.autocommit
+            row = self.new_row()
             row.load(r)
             self.dict[r[self.key_field_name]] = row
 
+    def new_row(self):
+        "Create a record proxy linked to this shelf (to track modifications)"
+        row = Row(self.db, self.table_name)
+        row.autocommit = self.autocommit
+        row.shelf = weakref.ref(self)
+        return row
+
     def keys(self):
         return self.dict.keys()
 
@@ -349,12 +436,12 @@ class DictShelf(UserDict.DictMixin):
     def __setitem__(self, key, value):
         # create a new Row proxy (value should be a dict!)
         if not isinstance(value, Row):
-            row = Row(self.db, self.table_name)
-            row.autocommit = self.autocommit
+            row = self.new_row()
             value.update(self.filters)
             row.update(value)
         else:
             row = value
+            row.shelf = weakref.ref(self)
         row[self.key_field_name] = key
         self.dict[key] = row
         
@@ -371,20 +458,24 @@ class DictShelf(UserDict.DictMixin):
         del self.dict[key]
 
     def close(self):
-        self.sync(self.autocommit)
+        if self.autocommit:
+            self.flush()
+        else:
+            self.sync(False)
 
     def __del__(self):
         self.close()
 
     def sync(self, commit=True):
-        "Write back all the changes to the database" 
+        "Write back all the changes to the database (see delay & threshold)" 
         if commit and self.dict is not None:
-            for row in self.dict.values():
-                row.save()
-            for row in self.deleted:
-                row.erase()
-            self.deleted = []
-            self.db.commit()
+            # write-behind: keep the changes in memory for a while
+            # (except deletions: the erased rows should not come back)
+            if (not self.delay or self.deleted or
+                len(self.dirty) >= self.threshold or
+                self.delay is not None and
+                time.time() - self.last_flush >= self.delay):
+                self.flush()
         elif self.dict is not None:
             # destroy internal dict to avoid commit later (TODO: requery)
             self.dict = None
@@ -392,6 +483,39 @@ class DictShelf(UserDict.DictMixin):
             self.db.rollback()
             self.db.close()
 
+    def flush(self):
+        "Write the modified and deleted rows now (in batches) and commit"
+        if self.dict is None:
+            return
+        pk = self.table_name + "_id"
+        deleted = [row for row in self.deleted if row.primary_key]
+        # group the updates by the fields changed, so they can be batched
+        updates = {}
+        for row in self.dirty.values():
+            if not row.data_out or row in self.deleted:
+                continue
+            elif row.primary_key:
+                fields = tuple(sorted(row.data_out))
+                updates.setdefault(fields, []).append(row)
+            else:
+                row.save()              # insert it to get the new id
+        for fields, rows in updates.items():
+            values = [[row.data_out[k] for k in fields] + [row.primary_key[pk]]
+                      for row in rows]
+            self.db.update_many(self.table_name, fields, values)
+            for row in rows:
+                row.data_in.update(row.data_out)
+                row.data_out = {}
+        if deleted:
+            self.db.delete_many(self.table_name, 
+                                [row.primary_key[pk] for row in deleted])
+        for row in self.deleted:
+            row.data_out = {}           # do not autocommit erased records
+        self.deleted = []
+        self.dirty = {}
+        self.db.commit()
+        self.last_flush = time.time()
+
 
 class ListShelf(DictShelf):
     "Database shelve replacement implementation (list-like object)"
@@ -11,8 +11,13 @@ __license__ = "GPL 3.0"
 
 from multiprocessing.connection import Listener
 from threading import Thread
+from collections import deque, OrderedDict
+from Queue import Queue, Empty
 import compiler
+import hashlib
 import os
+import select
+import socket
 import sys
 import traceback
 import wx
@@ -22,12 +27,34 @@ from wx.lib.mixins.listctrl import ListCtrlAutoWidthMixin
 import qdb
 
 # Define notification event for thread completion
-EVT_DEBUG_ID, EVT_EXCEPTION_ID = [wx.NewId() for i in range(2)]
+EVT_DEBUG_ID, EVT_EXCEPTION_ID, EVT_PROFILE_ID, EVT_LINE_PROFILE_ID = \
+    [wx.NewId() for i in range(4)]
 
 # Default debugger constants:
 HOST = '127.0.0.1'              # for remote sessions use '' (listen on all IP)
 PORT = 6000
 AUTH_KEY = 'secret password'    # change or configure ide2py.ini
+MAX_IDLE_MESSAGES = 100         # messages processed per idle event (UI lag)
+SELECT_TIMEOUT = 1              # seconds to check for closed sessions
+MAX_CACHED_SOURCES = 100        # remote files kept in memory (see ReadFile)
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+
+def socket_pair():
+    "Return two connected sockets (socket.socketpair is not portable)"
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        server.bind(("127.0.0.1", 0))
+        server.listen(1)
+        client = socket.create_connection(server.getsockname())
+        conn, address = server.accept()
+    finally:
+        server.close()
+    return conn, client
 
 
 class DebugEvent(wx.PyEvent):
@@ -57,6 +84,20 @@ class LoggingPipeWrapper(object):
         if isinstance(sys.stdout, file):
             print("PIPE:recv: #%s %s %s %s %s" % self.__format(data))
         return data
+
+    def send_bytes(self, data):
+        if isinstance(sys.stdout, file):
+            print("PIPE:send_bytes: #%s %s" % (self.__pipe.fileno(), len(data)))
+        self.__pipe.send_bytes(data)
+
+    def recv_bytes(self):
+        data = self.__pipe.recv_bytes()
+        if isinstance(sys.stdout, file):
+            print("PIPE:recv_bytes: #%s %s" % (self.__pipe.fileno(), len(data)))
+        return data
+
+    def fileno(self):
+        return self.__pipe.fileno()
     
     def close(self):
         self.__pipe.close()
@@ -64,7 +105,77 @@ class LoggingPipeWrapper(object):
     def poll(self):
         return self.__pipe.poll()
 
-        
+
+class SessionPipe(object):
+    "Connection fed by the proxy I/O loop (messages are queued, not polled)"
+
+    offline = False                 # see qdb.SnapshotPipe
+
+    def __init__(self, conn, address, proxy):
+        self.conn = conn
+        self.address = address
+        self.proxy = proxy
+        self.debugger = None        # created at the GUI thread (see pump)
+        self.inbox = deque()        # raw messages received (None on EOF)
+        self.closed = False
+        self.ident = None           # remote thread id (multiplexed sessions)
+        self.threads = {}           # thread id: ThreadSessionPipe
+
+    def send(self, data):
+        self.conn.send(data)
+
+    def send_bytes(self, data):
+        self.conn.send_bytes(data)
+
+    def recv_bytes(self):
+        # wait the I/O loop (dispatching messages of other sessions too)
+        while not self.inbox:
+            self.proxy.pump(block=True)
+        data = self.inbox.popleft()
+        if data is None:
+            raise EOFError("session closed by the remote side")
+        return data
+
+    def recv(self):
+        return pickle.loads(self.recv_bytes())
+
+    def poll(self, *args):
+        if not self.inbox:
+            self.proxy.pump()
+        return bool(self.inbox)
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def close(self):
+        self.closed = True
+        self.conn.close()
+
+
+class ThreadSessionPipe(SessionPipe):
+    "Session of a remote thread (messages tagged with its id, same conn.)"
+
+    def __init__(self, parent, ident):
+        SessionPipe.__init__(self, parent.conn, parent.address, parent.proxy)
+        self.parent = parent
+        self.ident = ident
+
+    def send(self, data):
+        self.send_bytes(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+    def send_bytes(self, data):
+        header = qdb.THREAD_TAG + qdb.THREAD_HEADER.pack(self.ident)
+        self.conn.send_bytes(header + data)
+
+    def close(self):
+        self.closed = True
+        if self.parent.threads.get(self.ident) is self:
+            del self.parent.threads[self.ident]
+        # close the connection if the remote process is gone
+        if self.parent.closed and not self.parent.threads:
+            self.conn.close()
+
+
 class DebuggerProxy(object):
     "Facade for the pool of debuggers (one for each connection)" 
 
@@ -75,6 +186,12 @@ class DebuggerProxy(object):
         self.pool = []
         self.current = None
         self.pool_info = {}
+        self.sessions = []          # connections read by the I/O loop
+        self.accepted = Queue()     # new sessions (see accept_connections)
+        self.queue = Queue()        # (session, message) for the GUI thread
+        self.pending = False        # GUI processing already scheduled
+        self.watches = []           # expressions evaluated at each stop
+        self.sources = OrderedDict()  # remote files LRU: {sha1: content}
         try:
             self.listener = Listener(address, authkey=authkey)
         except IOError as e:
@@ -88,37 +205,136 @@ class DebuggerProxy(object):
             dlg.Destroy()
             wx.GetApp().Exit()
 
-        # create a new thread to listen (it will block between each connection)
+        # create a new thread for the I/O loop (it will sleep in select)
         p = Thread(target=self.listen)
         p.daemon = True                     # close on exit
         wx.CallLater(3, p.start)            # give time to the IDE for startup
-        self.gui.Bind(wx.EVT_IDLE, self.OnIdle)  # schedule debugger execution
     
-    def OnIdle(self, event):
-        "Process incoming messages from backend debuggers"
-        # NOTE: only one event handler to avoid issues with IDLE events
-        # if not, just the last debugger binded got the events (RequestMore...)
-        for debugger in self.pool:
-            debugger.OnIdle(event)
-
     def listen(self):
-        "Main loop: accept incoming connections and launch new debuggers"
-        # Note: listener doesn't support select/polling, so accept will block
+        "I/O loop: read all the sessions (connections are accepted apart)"
+        # the listener doesn't support select: accept in other thread and
+        # wake up this loop thru a local socket when a session is added
+        waker, self.waker = socket_pair()
+        p = Thread(target=self.accept_connections)
+        p.daemon = True
+        p.start()
+        while True:
+            self.sessions = [s for s in self.sessions if not s.closed]
+            try:
+                while True:
+                    self.sessions.append(self.accepted.get_nowait())
+            except Empty:
+                pass
+            try:
+                ready = select.select([waker] + self.sessions, [], [], 
+                                      SELECT_TIMEOUT)[0]
+            except (select.error, ValueError, IOError):
+                # a session was closed by the GUI thread, check again
+                continue
+            for session in ready:
+                if session is waker:
+                    waker.recv(1024)        # new sessions already queued
+                    continue
+                try:
+                    data = session.conn.recv_bytes()
+                except (EOFError, IOError):
+                    # remote side disconnected, signal it with None:
+                    session.closed = True
+                    for thread in session.threads.values():
+                        self.notify(thread, None)
+                    self.notify(session, None)
+                    continue
+                if data[:1] == qdb.THREAD_TAG:
+                    # multiplexed connection, look for the thread session
+                    self.demux(session, data)
+                else:
+                    self.notify(session, data)
+
+    def accept_connections(self):
+        "Wait for incoming connections and queue them for the I/O loop"
         while True:
-            # create a new debugger:
-            conn = self.listener.accept()
+            # create a new session (the debugger is created later)
+            try:
+                conn = self.listener.accept()
+            except Exception, e:
+                # do not stop the loop (i.e. AuthenticationError)
+                print "DEBUGGER connection rejected:", e
+                continue
             address = self.listener.last_accepted
-            debugger = Debugger(self.gui, proxy=self)
-            debugger.attach(conn, address, self.start_continue)
-            self.pool.append(debugger)
-            self.pool_info[debugger] = address
-            # set the new one as current
-            self.current = debugger
-            self.refresh()
+            self.accepted.put(SessionPipe(conn, address, self))
+            self.waker.send("\0")
+
+    def demux(self, session, data):
+        "Dispatch a message tagged with the remote thread id (I/O loop)"
+        size = qdb.THREAD_HEADER.size
+        ident = qdb.THREAD_HEADER.unpack(data[1:1 + size])[0]
+        data = data[1 + size:]
+        thread = session.threads.get(ident)
+        if not data:
+            # empty message: the remote thread finished
+            session.threads.pop(ident, None)
+            data = None
+        elif not thread or thread.closed:
+            # new thread (or thread id reused)
+            thread = session.threads[ident] = ThreadSessionPipe(session, ident)
+        if thread:
+            self.notify(thread, data)
+
+    def notify(self, session, data):
+        "Queue a message and wake up the GUI thread (if not done already)"
+        self.queue.put((session, data))
+        if not self.pending:
+            self.pending = True
+            wx.CallAfter(self.process)
+
+    def pump(self, block=False):
+        "Distribute queued messages to the sessions inbox (GUI thread)"
+        try:
+            while True:
+                session, data = self.queue.get(block)
+                block = False       # only wait for the first message
+                if not session.debugger:
+                    if data is None:
+                        continue    # ignore (no messages were received)
+                    # first message: create a new debugger
+                    self.accept(session)
+                session.inbox.append(data)
+        except Empty:
+            pass
+
+    def process(self):
+        "Run the debuggers with pending messages (called by the I/O loop)"
+        self.pending = False
+        self.pump()
+        more = False
+        for debugger in self.pool[:]:
+            if debugger.pipe and debugger.pipe.poll():
+                more = debugger.OnIdle(None) or more
+        if more and not self.pending:
+            # do not freeze the UI, continue on the next event
+            self.pending = True
+            wx.CallAfter(self.process)
+
+    def accept(self, session):
+        "Launch a new debugger for the incoming connection"
+        debugger = Debugger(self.gui, proxy=self)
+        session.debugger = debugger
+        debugger.attach(session, session.address, self.start_continue)
+        self.pool.append(debugger)
+        self.pool_info[debugger] = session.address
+        # set the new one as current
+        self.current = debugger
+        self.refresh()
     
     def refresh(self):
         "Update the sessions list control pane"
-        items = [self.pool_info[dbg] + dbg.info[1:] for dbg in self.pool] 
+        items = []
+        for dbg in self.pool:
+            info = list(dbg.info[1:])
+            if info and dbg.thread_id is not None:
+                # multiplexed session, show the thread id too
+                info[1] = "%s (%s)" % (info[1], dbg.thread_id)
+            items.append(self.pool_info[dbg] + tuple(info))
         selected_index = self.pool.index(self.current) if self.current else None
         self.gui.sessions.BuildList(items, selected_index)
     
@@ -141,6 +357,31 @@ class DebuggerProxy(object):
         "Set initial parameters for debuggers to be created"
         self.start_continue = cont
     
+    def set_watches(self, exprs):
+        "Change the watch expressions of all the sessions"
+        self.watches = list(exprs)
+        values = []
+        for debugger in self.pool:
+            watches = debugger.SetWatches(self.watches)
+            if debugger is self.current:
+                values = watches
+        return values
+
+    def replay(self, filename):
+        "Open a post-mortem snapshot as a read-only session"
+        session = qdb.SnapshotPipe(qdb.load_snapshot(filename))
+        debugger = Debugger(self.gui, proxy=self)
+        session.debugger = debugger
+        debugger.attach(session, ("snapshot", filename), False)
+        self.pool.append(debugger)
+        self.pool_info[debugger] = debugger.address
+        self.current = debugger
+        self.refresh()
+        # process the startup, exception and interaction messages
+        if not self.pending:
+            self.pending = True
+            wx.CallAfter(self.process)
+
     def remove(self, debugger):
         "Delete detached debugger from the pool"
         self.pool.remove(debugger)
@@ -166,13 +407,28 @@ class Debugger(qdb.Frontend):
         self.pipe = None
         self.proxy = proxy
         self.breakpoints = []       # local side to speed-up processing
+        self.output = []            # console output buffer (see flush_output)
+        self.session = None         # connection (see DebuggerProxy.accept)
+        self.thread_id = None       # remote thread (multiplexed sessions)
+        self.completions = {}       # (method, expr): result (same stop)
+        self.files = {}             # remote files stats (current stop)
 
     def OnIdle(self, event):
         "Debugger main loop: read and execute remote methods"
+        # returns True if there are more messages to process
         try:
             if self.attached and self.pipe:
+                count = MAX_IDLE_MESSAGES
                 while self.pipe.poll():
                     self.run()
+                    count -= 1
+                    if not count:
+                        # do not freeze the UI, continue on the next event
+                        if event:
+                            event.RequestMore()
+                        self.flush_output()
+                        return True
+                self.flush_output()
         except EOFError:
             print "DEBUGGER disconnected..."
             self.detach()
@@ -197,23 +453,32 @@ class Debugger(qdb.Frontend):
         self.address = address
         self.attached = True
         print "DEBUGGER accepted connection from", self.address
+        self.session = conn
+        self.thread_id = getattr(conn, "ident", None)
         self.pipe = LoggingPipeWrapper(conn)
         print "DEBUGGER connected!"
     
     def detach(self):
         self.attached = False
+        self.flush_output()
         if self.pipe:
             self.pipe.close()
         self.clear_interaction()
         # just in case, send a KILL signal to child process
-        self.gui.OnKill(None)
-        # notify our proxy to remove this connection
-        if self.proxy:
+        # (unless it is a thread and the remote process is still connected)
+        session = getattr(self.session, "parent", self.session)
+        if not session or session.closed and not session.threads and \
+                                          not session.offline:
+            self.gui.OnKill(None)
+        # notify our proxy to remove this connection (note: proxy is False
+        # if there is no current debugger, so check it explicitly)
+        if self.proxy is not None:
             self.proxy.remove(self)
 
     def is_remote(self):
         # NOTE: if using a reverse tunnel (ssh), listen in a LAN IP address!
-        return (self.attached and 
+        # (snapshot sessions are offline, their files are read locally)
+        return (self.attached and not self.session.offline and
                 self.address[0] not in ("localhost", "127.0.0.1"))
 
     def check_interaction(fn):
@@ -299,7 +564,12 @@ class Debugger(qdb.Frontend):
         print "loading breakpoints...."
         self.LoadBreakpoints()
         print "enabling call_stack and environment at interaction"
-        self.set_params(dict(call_stack=True, environment=True, postmortem=True))
+        params = dict(call_stack=True, environment=True, postmortem=True,
+                      delta=True, files=True)
+        if self.proxy is not None and self.proxy.watches:
+            print "enabling watches at interaction"
+            params['watches'] = self.proxy.watches
+        self.set_params(params)
         # return control to the backend:
         qdb.Frontend.startup(self, *args)
         # update the session list UI
@@ -308,6 +578,12 @@ class Debugger(qdb.Frontend):
 
     def interaction(self, filename, lineno, line, **context):
         "Start user interaction -show current line- (called by the backend)"
+        self.flush_output()
+        # rebuild the call stack and environment (only changes were sent)
+        context = self.merge_context(context)
+        # stats may be outdated (modified files), only trust the new ones
+        self.files = context.pop('files', {})
+        self.completions.clear()
         self.interacting = True
         try:
             # on startup, do not step-by-step if user pressed F5 or similar
@@ -326,6 +602,10 @@ class Debugger(qdb.Frontend):
                 self.context = context
                 self.line = line
                 if self.gui and self.post_event:
+                    if self.proxy is not None and self.proxy.current is not self:
+                        # other session (i.e. thread) stopped, select it:
+                        self.proxy.current = self
+                        self.proxy.refresh()
                     # send the event to mark the current line
                     self.activate_current_line()
                 else:
@@ -340,11 +620,24 @@ class Debugger(qdb.Frontend):
                          (self.filename, self.lineno, self.context, self.line)))            
     
     def write(self, text):
-        "ouputs a message (called by the backend)"
-        self.gui.Write(text)
+        "ouputs a message (called by the backend, buffered)"
+        self.output.append(text)
+
+    def flush_output(self):
+        "Append the buffered console output (as a whole chunk)"
+        if self.output:
+            try:
+                chunks = [u"".join(self.output)]
+            except UnicodeDecodeError:
+                # non-ascii str, let the console decode each one
+                chunks = self.output[:]
+            del self.output[:]
+            for text in chunks:
+                self.gui.Write(text)
 
     def readline(self):
         "returns a user input (called by the backend)"
+        self.flush_output()
         # "raw_input" should be atomic and uninterrupted
         try:
             self.interacting = None
@@ -354,10 +647,22 @@ class Debugger(qdb.Frontend):
 
     def exception(self, *args):
         "Notify that a user exception was raised in the backend"
+        self.flush_output()
         if not self.unrecoverable_error:
             wx.PostEvent(self.gui, DebugEvent(EVT_EXCEPTION_ID, args))
             self.unrecoverable_error = u"%s" % args[0]
 
+    def profile(self, stacks, samples, interval):
+        "Update the profiler results (called by the backend periodically)"
+        qdb.Frontend.profile(self, stacks, samples, interval)
+        self.flush_output()
+        wx.PostEvent(self.gui, DebugEvent(EVT_PROFILE_ID, self.stacks))
+
+    def line_profile(self, stats, elapsed):
+        "Show the line profiler results (called by the backend at exit)"
+        self.flush_output()
+        wx.PostEvent(self.gui, DebugEvent(EVT_LINE_PROFILE_ID, (stats, elapsed)))
+
     def check_running_code(self, func_name):
         "Edit and continue functionality -> True=ok or False=restart"
         # only check edited code for the following methods:
@@ -463,18 +768,20 @@ class Debugger(qdb.Frontend):
 
     def LoadBreakpoints(self):
         "Set all breakpoints (remotelly, used at initialization)"
-        # get a list of {filename: {lineno: (temp, cond)}
+        # get a list of {filename: {lineno: (temp, cond, hits, log)}
         for filename, bps in self.gui.GetBreakpoints():
             for bp in bps.values():
                 print "loading breakpoint", filename, bp['lineno']
                 lineno = bp['lineno']
-                self.do_set_breakpoint(filename, lineno, bp['temp'], bp['cond'])
+                self.do_set_breakpoint(filename, lineno, bp['temp'], bp['cond'],
+                                       bp.get('hits'), bp.get('log'))
                 self.breakpoints.append((filename, lineno))
 
     @force_interaction
-    def SetBreakpoint(self, filename, lineno, temporary=0, cond=None):
+    def SetBreakpoint(self, filename, lineno, temporary=0, cond=None,
+                      hits=None, log=None):
         "Set the specified breakpoint (remotelly)"
-        self.do_set_breakpoint(filename, lineno, temporary, cond)
+        self.do_set_breakpoint(filename, lineno, temporary, cond, hits, log)
         self.breakpoints.append((filename, lineno))
 
     @force_interaction
@@ -526,11 +833,51 @@ class Debugger(qdb.Frontend):
                 self.readline = old_readline
                 
 
-    @check_interaction
+    def SetWatches(self, exprs):
+        "Change the watch expressions, returns their values (if interacting)"
+        # not mutually exclusive: running sessions get them on the next stop
+        # (and the current interaction, if any, should not be cleared)
+        if self.pipe and self.attached:
+            if self.interacting:
+                try:
+                    return self.set_watches(exprs)
+                except qdb.RPCError, e:
+                    return [(expr, "", u'*** %s' % unicode(e)) for expr in exprs]
+            elif self.interacting is not None:
+                # running: they will be evaluated on the next interaction
+                # (not while waiting a readline, the backend expects its input)
+                self.set_params({'watches': exprs})
+        return []
+
     def ReadFile(self, filename):
-        "Load remote file"
+        "Load remote file (only transfer it if not cached)"
         from cStringIO import StringIO
-        data = self.do_read(filename)
+        if filename not in self.files:
+            # not announced at this stop (not in the call stack or unchanged)
+            self.files[filename] = self.do_stat(filename)
+        size, mtime, digest = self.files[filename]
+        cache = self.proxy.sources if self.proxy is not None else OrderedDict()
+        data = cache.pop(digest, None)
+        if data is None:
+            # stream the content in chunks (do not block the connection)
+            chunks = []
+            offset = 0
+            while offset < size:
+                chunk = self.do_read_chunk(filename, offset)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+                offset += len(chunk)
+            data = "".join(chunks)
+            if hashlib.sha1(data).hexdigest() != digest:
+                digest = None   # changed while reading, do not cache it
+            # raw bytes were transferred (hash): apply universal newlines
+            data = data.replace("\r\n", "\n").replace("\r", "\n")
+        if digest:
+            # keep the most recently used files only
+            cache[digest] = data
+            while len(cache) > MAX_CACHED_SOURCES:
+                cache.popitem(last=False)
         return StringIO(data)
 
     @check_interaction
@@ -547,6 +894,16 @@ class Debugger(qdb.Frontend):
         d['environment'] = env
         return d
 
+    def Expand(self, path, offset=0):
+        "Request a page of child variables (environment lazy inspection)"
+        if self.pipe and self.attached and self.interacting:
+            try:
+                self.set_burst(2)   # do not resend the interaction
+                return self.do_expand(path, offset)
+            except qdb.RPCError, e:
+                self.gui.ShowInfoBar("cannot inspect: %s" % e,
+                                     flags=wx.ICON_INFORMATION, key="debugger")
+
     # methods used by the shell:
     
     def Exec(self, statement, write=None, readline=None):
@@ -568,6 +925,7 @@ class Debugger(qdb.Frontend):
                 if readline:
                     self.readline = readline
                 self.post_event = None   # ignore one interaction notification
+                self.completions.clear() # variables could be changed
                 # execute the statement in the remote debugger:
                 ret = self.do_exec(statement)
                 if isinstance(ret, basestring):
@@ -584,18 +942,26 @@ class Debugger(qdb.Frontend):
     def GetAutoCompleteList(self, expr=''):
         "Return list of auto-completion options for an expression"
         if self.pipe and self.attached and self.interacting:
+            key = ('get_autocomplete_list', expr)
+            if key in self.completions:
+                return self.completions[key]    # no round trip (same stop)
             try:
                 self.post_event = None   # ignore one interaction notification
-                return self.get_autocomplete_list(expr)
+                ret = self.completions[key] = self.get_autocomplete_list(expr)
+                return ret
             except qdb.RPCError, e:
                 return u'*** %s' % unicode(e)
 
     def GetCallTip(self, expr):
         "Returns (name, argspec, tip) for an expression"
         if self.pipe and self.attached and self.interacting:
+            key = ('get_call_tip', expr)
+            if key in self.completions:
+                return self.completions[key]    # no round trip (same stop)
             try:
                 self.post_event = None   # ignore one interaction notification
-                return self.get_call_tip(expr)
+                ret = self.completions[key] = self.get_call_tip(expr)
+                return ret
             except qdb.RPCError, e:
                 return u'*** %s' % unicode(e)
     
@@ -618,12 +984,18 @@ class EnvironmentPanel(wx.Panel):
         self.tree.SetMainColumn(0) # the one with the tree in it...
         self.tree.SetColumnWidth(0, 175)
         self.tree.Bind(wx.EVT_TREE_ITEM_ACTIVATED, self.OnActivate)
+        self.tree.Bind(wx.EVT_TREE_ITEM_EXPANDING, self.OnExpanding)
 
-    def BuildItem(self, item, txt, cols=None):
+    def BuildItem(self, item, txt, cols=None, data=None, has_children=False):
         child = self.tree.AppendItem(item, txt)
         if cols:
             for i, col in enumerate(cols):
                 self.tree.SetItemText(child, col, i+1)
+        if data is not None:
+            self.tree.SetItemPyData(child, data)
+        if has_children:
+            # children will be requested on demand (see OnExpanding)
+            self.tree.SetItemHasChildren(child, True)
         return child
         
     def BuildTree(self, scopes, sort_order):
@@ -631,33 +1003,127 @@ class EnvironmentPanel(wx.Panel):
         self.root = self.tree.AddRoot("The Root Item")
         # process locals and globals
         for i, key in enumerate(sort_order):
-            vars = scopes.get(key)
+            page = scopes.get(key)
             child = self.BuildItem(self.root, key)
-            if not vars:
+            if not page:
                 continue
-            for var_name, (var_repr, var_type) in vars.items():
-                self.BuildItem(child, var_name, (var_type, var_repr))
+            self.BuildPage(child, page)
             if i == 0:
                 self.tree.Expand(child)
         self.tree.Expand(self.root)
 
+    def BuildPage(self, item, page):
+        "Append a page of variables (name, index, type, repr, has children)"
+        path = page['path']
+        for var_name, index, var_type, var_repr, children in page['items']:
+            self.BuildItem(item, var_name, (var_type, var_repr), 
+                           {'path': path + (index, )}, children)
+        offset = page['offset'] + len(page['items'])
+        if offset < page['count']:
+            # placeholder to request the next page (see OnActivate)
+            self.BuildItem(item, "...", 
+                           ("", "%d more" % (page['count'] - offset)),
+                           {'more': (path, offset)})
+
+    def OnExpanding(self, evt):
+        "Request the children of a variable (only the first time)"
+        item = evt.GetItem()
+        data = self.tree.GetItemPyData(item)
+        if data and 'path' in data and not data.get('loaded'):
+            data['loaded'] = True
+            page = self.debugger.current.Expand(data['path'])
+            if page:
+                self.BuildPage(item, page)
+
     def OnSize(self, evt):
         self.tree.SetSize(self.GetSize())
 
     def OnActivate(self, evt):
         "When a item is clicked, ask for a new value and try to update it"
+        data = self.tree.GetItemPyData(evt.GetItem())
+        if data and 'more' in data:
+            # replace the placeholder with the next page of variables
+            parent = self.tree.GetItemParent(evt.GetItem())
+            page = self.debugger.current.Expand(*data['more'])
+            if page:
+                self.tree.Delete(evt.GetItem())
+                self.BuildPage(parent, page)
+            return
+        elif not data or len(data['path']) != 2:
+            return  # only scope variables can be edited
         # get name of activated item:
         var = self.tree.GetItemText(evt.GetItem())
         if var:
             # get current value (default) and open a dialog asking the new one
             val = self.tree.GetItemText(evt.GetItem(), 2)
-            val = self.debugger.modal_readline("New value for %s" % var, val)
+            val = self.debugger.current.modal_readline("New value for %s" % var, val)
             # only edit if user has input text
             if val:
-                ret = self.debugger.Exec("%s = %s" % (var, val))
+                ret = self.debugger.current.Exec("%s = %s" % (var, val))
                 # return value should be None, if not, show error message:
                 if ret != 'None':
-                    self.debugger.modal_write(ret)
+                    self.debugger.current.modal_write(ret)
+
+
+class ProfilePanel(wx.Panel):
+    "Sampling profiler results (call tree built from the folded stacks)"
+    def __init__(self, parent=None):
+        wx.Panel.__init__(self, parent, -1)
+        self.Bind(wx.EVT_SIZE, self.OnSize)
+        self.parent = parent
+        self.tree = wx.gizmos.TreeListCtrl(self, -1, style =
+                                        wx.TR_DEFAULT_STYLE
+                                        | wx.TR_HIDE_ROOT
+                                        | wx.TR_FULL_ROW_HIGHLIGHT
+                                   )
+        self.tree.AddColumn("Function")
+        self.tree.AddColumn("Total")
+        self.tree.AddColumn("Self")
+        self.tree.AddColumn("%")
+        self.tree.SetMainColumn(0)
+        self.tree.SetColumnWidth(0, 250)
+        self.tree.Bind(wx.EVT_TREE_ITEM_ACTIVATED, self.OnActivate)
+
+    def BuildTree(self, stacks):
+        "Merge the folded stacks ('file:lineno:name;...': samples) in a tree"
+        root = {'total': 0, 'self': 0, 'children': {}}
+        for stack, count in stacks.items():
+            node = root
+            node['total'] += count
+            for label in stack.split(";"):
+                node = node['children'].setdefault(label, 
+                            {'total': 0, 'self': 0, 'children': {}})
+                node['total'] += count
+            node['self'] += count
+        self.tree.DeleteAllItems()
+        item = self.tree.AddRoot("The Root Item")
+        self.BuildNodes(item, root, float(root['total'] or 1), 2)
+
+    def BuildNodes(self, item, node, total, expand=0):
+        "Append the children (hottest first) and expand the first levels"
+        children = sorted(node['children'].items(), 
+                          key=lambda child: child[1]['total'], reverse=True)
+        for label, child in children:
+            filename, lineno, name = label.rsplit(":", 2)
+            txt = "%s (%s:%s)" % (name, os.path.basename(filename), lineno)
+            new = self.tree.AppendItem(item, txt)
+            self.tree.SetItemText(new, str(child['total']), 1)
+            self.tree.SetItemText(new, str(child['self']), 2)
+            self.tree.SetItemText(new, "%.1f" % (child['total'] / total * 100), 3)
+            self.tree.SetItemPyData(new, (filename, int(lineno)))
+            self.BuildNodes(new, child, total, expand - 1)
+            if expand > 0:
+                self.tree.Expand(new)
+
+    def OnSize(self, evt):
+        self.tree.SetSize(self.GetSize())
+
+    def OnActivate(self, evt):
+        "Open the function source code"
+        data = self.tree.GetItemPyData(evt.GetItem())
+        if data:
+            filename, lineno = data
+            self.parent.GotoFileLine((filename, lineno, 0), running=False)
 
 
 class StackListCtrl(wx.ListCtrl, ListCtrlAutoWidthMixin):
@@ -695,6 +1161,65 @@ class StackListCtrl(wx.ListCtrl, ListCtrlAutoWidthMixin):
             self.AddItem(item)
 
 
+class WatchListCtrl(wx.ListCtrl, ListCtrlAutoWidthMixin):
+    "Watch window (expression, type, value), evaluated at each interaction"
+    def __init__(self, parent):
+        wx.ListCtrl.__init__(self, parent, -1, 
+            style=wx.LC_REPORT | wx.LC_SINGLE_SEL | wx.LC_ALIGN_LEFT)
+        ListCtrlAutoWidthMixin.__init__(self)
+        self.parent = parent
+        self.InsertColumn(0, "Expression", wx.LIST_FORMAT_LEFT) 
+        self.SetColumnWidth(0, 150)
+        self.InsertColumn(1, "Type", wx.LIST_FORMAT_LEFT)
+        self.SetColumnWidth(1, 100)
+        self.InsertColumn(2, "Value", wx.LIST_AUTOSIZE) 
+        self.setResizeColumn(3)
+        self.Bind(wx.EVT_LIST_ITEM_ACTIVATED, self.OnItemActivated, self)
+        self.Bind(wx.EVT_LIST_KEY_DOWN, self.OnKeyDown, self)
+
+    def AddItem(self, item, key=None):
+        index = self.InsertStringItem(sys.maxint, item[0])
+        for i, val in enumerate(item[1:]):
+            if isinstance(val, str):
+                val = val.decode("utf8", "replace")
+            self.SetStringItem(index, i+1, val)
+
+    def BuildList(self, items):
+        "Show the values received (in the order the watches were added)"
+        self.DeleteAllItems()
+        values = dict([(item[0], item) for item in items])
+        for expr in self.parent.debugger.watches:
+            self.AddItem(values.get(expr, (expr, "", "")))
+
+    def AddWatch(self, expr):
+        watches = self.parent.debugger.watches + [expr]
+        self.BuildList(self.parent.debugger.set_watches(watches))
+
+    def OnItemActivated(self, evt):
+        "Edit the expression (remove it if it is empty)"
+        watches = self.parent.debugger.watches[:]
+        index = evt.m_itemIndex
+        dlg = wx.TextEntryDialog(self, "Expression to watch:", "Edit Watch", 
+                                 watches[index])
+        if dlg.ShowModal() == wx.ID_OK:
+            expr = dlg.GetValue().strip()
+            if expr:
+                watches[index] = expr
+            else:
+                del watches[index]
+            self.BuildList(self.parent.debugger.set_watches(watches))
+        dlg.Destroy()
+
+    def OnKeyDown(self, evt):
+        "Remove the selected expression (DEL key)"
+        if evt.GetKeyCode() == wx.WXK_DELETE:
+            watches = self.parent.debugger.watches[:]
+            del watches[evt.m_itemIndex]
+            self.BuildList(self.parent.debugger.set_watches(watches))
+        else:
+            evt.Skip()
+
+
 class SessionListCtrl(wx.ListCtrl):
     "Call stack window (filename lineno flags, source)"
     def __init__(self, parent, filename=""):
@@ -750,7 +1275,9 @@ class TestFrame(wx.Frame):
         wx.Frame.__init__(self, None)
         self.Show()
         self.panel = EnvironmentPanel(self)
-        self.panel.BuildTree({'locals': {'saraza': ('str', 'none')}})
+        self.panel.BuildTree({'locals': {'path': ('locals', ), 'offset': 0, 
+                    'count': 1, 'items': [('saraza', 'saraza', 'str', 'none', 
+                                           False)]}}, sort_order=('locals', ))
         self.SendSizeEvent() 
 
 if __name__ == '__main__':
@@ -37,6 +37,7 @@ FACES = {'times': 'DejaVu Sans', 'mono': 'DejaVu Sans Mono',
 CALLTIPS = True # False or 'first paragraph only'     
 AUTOCOMPLETE = True
 AUTOCOMPLETE_IGNORE = []
+AUTOCOMPLETE_DELAY = 150    # ms without typing before querying completions
 
 TRACK_METADATA = False
 
@@ -47,6 +48,9 @@ class EditorCtrl(stc.StyledTextCtrl):
     BREAKPOINT_MARKER_NUM = 1
     CURRENT_LINE_MARKER_MASK = 2 ** CURRENT_LINE_MARKER_NUM
     BREAKPOINT_MARKER_MASK = 2 ** BREAKPOINT_MARKER_NUM
+    PROFILE_MARKER_NUM = 0x12
+    PROFILE_COLOURS = [(255, 250, 220), (255, 230, 180), (255, 200, 140), 
+                       (255, 165, 110), (255, 125, 90)]   # cold to hot
    
     def __init__(self, parent, ID,
                  pos=wx.DefaultPosition, size=wx.DefaultSize,
@@ -84,6 +88,7 @@ class EditorCtrl(stc.StyledTextCtrl):
         self.modified = None
         self.calltip = 0
         self.breakpoints = {}
+        self.line_stats = {}        # line profiler: {lineno: (hits, time)}
         self.metadata = metadata    # dict of uuid, origin for line tracking
         self.clipboard = None       # lines text and metadata for cut/paste
         self.actions_buffer = []    # insertions / deletions for undo and redo
@@ -164,6 +169,9 @@ class EditorCtrl(stc.StyledTextCtrl):
         self.MarkerDefine(self.BREAKPOINT_MARKER_NUM, wx.stc.STC_MARK_CIRCLE, wx.BLACK, (255,0,0))
         self.MarkerDefine(self.BREAKPOINT_MARKER_NUM+1, wx.stc.STC_MARK_PLUS, wx.BLACK, wx.WHITE)
         self.MarkerDefine(self.BREAKPOINT_MARKER_NUM+2, wx.stc.STC_MARK_DOTDOTDOT, wx.BLACK, wx.BLUE)
+        # Define the line profiler heat markers (background)
+        for i, colour in enumerate(self.PROFILE_COLOURS):
+            self.MarkerDefine(self.PROFILE_MARKER_NUM+i, wx.stc.STC_MARK_BACKGROUND, wx.BLACK, colour)
 
         # Make some styles,  The lexer defines what each style is used for, we
         # just have to define what each style looks like.  This set is adapted from
@@ -221,6 +229,7 @@ class EditorCtrl(stc.StyledTextCtrl):
         
         # initialize autocompletion:
         self.autocomp = autocomp
+        self.autocomp_timer = None  # debounce (see AutoComplete)
 
 
     def SetStyles(self, lang='python', cfg_styles={}):
@@ -612,7 +621,19 @@ class EditorCtrl(stc.StyledTextCtrl):
     def AutoComplete(self, obj=0):
         if obj:
             self.AddText('.')
-            word = ''
+        # wait the user to stop typing (only query the last request)
+        if self.autocomp_timer:
+            self.autocomp_timer.Stop()
+        self.autocomp_timer = wx.CallLater(AUTOCOMPLETE_DELAY, 
+                                           self.DoAutoComplete, obj)
+
+    def DoAutoComplete(self, obj=0):
+        if not self:
+            return      # editor closed while waiting
+        self.autocomp_timer = None
+        if obj:
+            # text typed after the dot (if any) is used to filter the list
+            word = self._GetWord()
         else:
             word = self.GetWord()
         completions = self.autocomp.GetCompletions(**self.GetScriptParams())
@@ -714,7 +735,8 @@ class EditorCtrl(stc.StyledTextCtrl):
                     else:
                         self.ToggleFold(lineclicked)
 
-    def ToggleBreakpoint(self, evt=None, lineno=None, cond=None, temp=False):
+    def ToggleBreakpoint(self, evt=None, lineno=None, cond=None, temp=False,
+                         hits=None, log=None):
         # track breakpoints (only if debugger is available)
         ok = None if self.debugger is None else False
         if lineno is None:
@@ -738,7 +760,8 @@ class EditorCtrl(stc.StyledTextCtrl):
                     handle = None
                 # remove the main breakpoint marker (handle) and alternate ones
                 self.MarkerDeleteHandle(handle)
-                if self.breakpoints[handle]['cond']:
+                bp = self.breakpoints[handle]
+                if bp['cond'] or bp.get('hits') or bp.get('log'):
                     self.MarkerDelete(lineno - 1, self.BREAKPOINT_MARKER_NUM+1)
                 if self.breakpoints[handle]['temp']:
                     self.MarkerDelete(lineno - 1, self.BREAKPOINT_MARKER_NUM+2)
@@ -746,17 +769,19 @@ class EditorCtrl(stc.StyledTextCtrl):
         else:
             # set the breakpoint (if debugger is running) and marker
             if self.debugger:
-                ok = self.debugger.current.SetBreakpoint(self.filename, lineno, temp, cond)
+                ok = self.debugger.current.SetBreakpoint(self.filename, lineno, 
+                                                         temp, cond, hits, log)
             if ok is not None:
                 # set the main breakpoint marker (get handle)
                 handle = self.MarkerAdd(lineno - 1, self.BREAKPOINT_MARKER_NUM) 
                 # set alternate markers (if any)
-                if cond:
+                if cond or hits or log:
                     self.MarkerAdd(lineno - 1, self.BREAKPOINT_MARKER_NUM+1)
                 if temp:
                     self.MarkerAdd(lineno - 1, self.BREAKPOINT_MARKER_NUM+2)
                 # store the breakpoint in a struct for the debugger:
-                bp = {'lineno': lineno, 'temp': temp, 'cond': cond}
+                bp = {'lineno': lineno, 'temp': temp, 'cond': cond, 
+                      'hits': hits, 'log': log}
                 self.breakpoints[handle] = bp
 
     def ToggleAltBreakpoint(self, evt, lineno=None):
@@ -766,25 +791,45 @@ class EditorCtrl(stc.StyledTextCtrl):
             lineno += 1
         # search the breakpoint
         for handle in self.breakpoints:
-            if lineno == self.MarkerLineFromHandle(handle):
-                cond = self.breakpoints[handle]['cond']
+            if lineno - 1 == self.MarkerLineFromHandle(handle):
+                bp = self.breakpoints[handle]
+                cond, hits, log = bp['cond'], bp.get('hits'), bp.get('log')
+                temp = bp['temp']
+                # rebuild the previous text (with the prefixes, if any)
+                text = cond or ""
+                if hits:
+                    text = ("hits: %s %s" % (hits, text)).strip()
+                if log:
+                    text = "log: %s" % log
                 break
         else:
-            cond = temp = handle = None            
+            cond = temp = handle = hits = log = text = None
         # delete the breakpoint if it already exist:
-        if handle:
+        if handle is not None:
             self.ToggleBreakpoint(evt, lineno)
         # ask the condition
         dlg = wx.TextEntryDialog(self, "Conditional expression:"
-                                 "(empty for temporary 1 run breakpoint)", 
-                                 'Set Cond./Temp. Breakpoint', cond or "")
+                                 "(empty for temporary 1 run breakpoint)\n"
+                                 "'hits: N [cond]' to stop at the N hit, "
+                                 "'log: message {expr}' to only log", 
+                                 'Set Cond./Temp. Breakpoint', text or "")
         if dlg.ShowModal() == wx.ID_OK:
-            cond = dlg.GetValue() or None
-            temp = cond is None
+            cond = dlg.GetValue().strip() or None
+            hits = log = None
+            if cond and cond.startswith("log:"):
+                # log point (never stops, {expressions} are evaluated)
+                log = cond[4:].strip()
+                cond = None
+            elif cond and cond.startswith("hits:"):
+                # hit count (and an optional condition)
+                hits, _, cond = cond[5:].strip().partition(" ")
+                hits = int(hits)
+                cond = cond.strip() or None
+            temp = not (cond or hits or log)
         dlg.Destroy()
         # set the conditional / temporary breakpoint:
-        if cond or temp:
-            self.ToggleBreakpoint(evt, lineno, cond, temp)
+        if cond or temp or hits or log:
+            self.ToggleBreakpoint(evt, lineno, cond, temp, hits, log)
 
     def ClearBreakpoints(self, evt):
         lineno = 1
@@ -908,6 +953,22 @@ class EditorCtrl(stc.StyledTextCtrl):
             self.MarkerAdd(linenum, self.CURRENT_LINE_MARKER_NUM)
             self.MarkerAdd(linenum, self.CURRENT_LINE_MARKER_NUM+1)
    
+    def ShowLineProfile(self, stats, elapsed=None):
+        "Colour the lines according the time spent (line profiler results)"
+        for i in range(len(self.PROFILE_COLOURS)):
+            self.MarkerDeleteAll(self.PROFILE_MARKER_NUM + i)
+        self.line_stats = stats or {}
+        if not stats:
+            return
+        # relative to the whole execution (or the slowest line):
+        total = elapsed or max([seconds for hits, seconds in stats.values()])
+        levels = len(self.PROFILE_COLOURS)
+        for lineno, (hits, seconds) in stats.items():
+            ratio = seconds / (total or 1)
+            if ratio >= 0.01:
+                level = min(int(ratio * levels), levels - 1)
+                self.MarkerAdd(lineno - 1, self.PROFILE_MARKER_NUM + level)
+
     def GetLineText(self, linenum, encode=False, strip=True):
         "Get the contents of a line (i.e. used by debugger) LineNum is 1-based"
         text = self.GetLine(linenum - 1) 
@@ -1144,6 +1205,16 @@ class EditorCtrl(stc.StyledTextCtrl):
                 if value is not None:
                     expr_value = "%s = %s" % (expr, value)
                     wx.CallAfter(self.SetToolTipString, expr_value)
+                evt.Skip()
+                return
+        if self.line_stats and evt.GetPosition() >= 0:
+            # show the line profiler results (if any)
+            lineno = self.LineFromPosition(evt.GetPosition()) + 1
+            if lineno in self.line_stats:
+                hits, seconds = self.line_stats[lineno]
+                text = "%d hits, %.3f ms (%.3f ms per hit)" % (
+                            hits, seconds * 1000, seconds * 1000 / hits)
+                wx.CallAfter(self.SetToolTipString, text)
         evt.Skip()
         
     def OnEndHover(self, evt):
@@ -46,7 +46,9 @@ from autocompletion import AutocompletionManager
 from editor import EditorCtrl
 from shell import Shell
 from debugger import DebuggerProxy, EVT_DEBUG_ID, EVT_EXCEPTION_ID, \
-                     EnvironmentPanel, StackListCtrl, SessionListCtrl
+                     EVT_PROFILE_ID, EVT_LINE_PROFILE_ID, EnvironmentPanel, \
+                     StackListCtrl, SessionListCtrl, ProfilePanel, \
+                     WatchListCtrl
 from console import ConsoleCtrl
 from explorer import ExplorerPanel, EVT_EXPLORE_ID
 from task import TaskMixin
@@ -99,6 +101,9 @@ ID_FOLD = wx.NewId()
 ID_RUN = wx.NewId()
 ID_DEBUG = wx.NewId()
 ID_EXEC = wx.NewId()
+ID_PROFILE = wx.NewId()
+ID_LINE_PROFILE = wx.NewId()
+ID_SNAPSHOT = wx.NewId()
 ID_SETPYTHON = wx.NewId()
 ID_SETARGS = wx.NewId()
 ID_KILL = wx.NewId()
@@ -116,6 +121,7 @@ ID_CONTINUETO = wx.NewId()
 ID_QUIT = wx.NewId()
 ID_INTERRUPT = wx.NewId()
 ID_EVAL = wx.NewId()
+ID_WATCH = wx.NewId()
 
 ID_EXPLORER = wx.NewId()
 ID_DESIGNER = wx.NewId()
@@ -139,6 +145,7 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
         self.infobars = {}              # notifications (stackable panes)
         self.debugging_child = None     # current debugged file
         self.temp_breakpoint = None
+        self.line_stats = None          # last line profiler results
         self.lastprogargs = ""
         if wx.Platform == '__WXMSW__':
             self.pythonexec = sys.prefix.replace("\\", "/") + "/pythonw.exe"
@@ -207,6 +214,12 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
                                  "Execute program under debugger")
         run_menu.Append(ID_EXEC, "&Execute\tShift-Ctrl-F5", 
                                  "Full speed execution (no debugger)")
+        run_menu.Append(ID_PROFILE, "&Profile", 
+                                 "Execution sampling the stack (no tracing)")
+        run_menu.Append(ID_LINE_PROFILE, "Profile &Lines", 
+                                 "Execution timing each line (editor overlay)")
+        run_menu.Append(ID_SNAPSHOT, "Open Post-&mortem Snapshot", 
+                                 "Inspect a crash saved by qdb.snapshot_hook")
         run_menu.AppendSeparator()
         run_menu.Append(ID_KILL, "&Terminate\tCtrl-T", 
                                  "Kill external process")
@@ -236,6 +249,8 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
         dbg_menu.AppendSeparator()
         dbg_menu.Append(ID_EVAL, "Quick &Eval\tShift-F9", 
                         help="Evaluate selected text (expression) in context")
+        dbg_menu.Append(ID_WATCH, "Add &Watch", 
+                        help="Evaluate selected text at each interaction")
         dbg_menu.AppendSeparator()
         dbg_menu.Append(ID_BREAKPOINT, "Toggle &Breakpoint\tF9",
                         help="Set or remove a breakpoint in the current line")
@@ -320,6 +335,10 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
             (wx.ID_CLOSE, self.OnCloseChild),
             (ID_RUN, self.OnRun),
             (ID_EXEC, self.OnExecute),
+            (ID_PROFILE, self.OnProfile),
+            (ID_LINE_PROFILE, self.OnProfile),
+            (ID_SNAPSHOT, self.OnOpenSnapshot),
+            (ID_WATCH, self.OnAddWatch),
             (ID_SETPYTHON, self.OnSetPython),
             (ID_SETARGS, self.OnSetArgs),
             (ID_KILL, self.OnKill),
@@ -403,6 +422,18 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
               FloatingPosition(self.GetStartPosition()).DestroyOnClose(False).PinButton(True).
               MinSize((100, 100)).Right().Bottom().MinimizeButton(True))
 
+        self.watch = WatchListCtrl(self)
+        self._mgr.AddPane(self.watch, aui.AuiPaneInfo().Name("watch").
+              Caption("Watch").Float().FloatingSize(wx.Size(400, 100)).
+              FloatingPosition(self.GetStartPosition()).DestroyOnClose(False).PinButton(True).
+              MinSize((100, 100)).Right().Bottom().MinimizeButton(True))
+
+        self.profile = ProfilePanel(self)
+        self._mgr.AddPane(self.profile, aui.AuiPaneInfo().Name("profile").
+              Caption("Profile").Float().FloatingSize(wx.Size(400, 100)).
+              FloatingPosition(self.GetStartPosition()).DestroyOnClose(False).PinButton(True).
+              MinSize((100, 100)).Right().Bottom().MinimizeButton(True))
+
         self.sessions = SessionListCtrl(self)
         self._mgr.AddPane(self.sessions, aui.AuiPaneInfo().Name("sessions").
               Caption("Debug Sessions").Float().FloatingSize(wx.Size(400, 100)).
@@ -449,6 +480,8 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
         # Connect to debugging and explorer events
         self.Connect(-1, -1, EVT_DEBUG_ID, self.GotoFileLine)
         self.Connect(-1, -1, EVT_EXCEPTION_ID, self.OnException)
+        self.Connect(-1, -1, EVT_PROFILE_ID, self.OnProfileData)
+        self.Connect(-1, -1, EVT_LINE_PROFILE_ID, self.OnLineProfileData)
         self.Connect(-1, -1, EVT_EXPLORE_ID, self.OnExplore)
 
         # key bindings (shortcuts). TODO: configuration
@@ -757,6 +790,7 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
                 child = AUIChildFrameBrowser(self, filename, title)
             else:
                 child = AUIChildFrameEditor(self, filename, title, running)
+                self.ShowLineProfile(child)
                 if self.explorer:
                     wx.CallAfter(self.explorer.ParseFile, filename)
             child.Show()
@@ -826,7 +860,59 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
     def OnRun(self, event):
         self.OnExecute(event, debug=False)
         
-    def OnExecute(self, event, debug=True):
+    def OnProfile(self, event):
+        if event.GetId() == ID_LINE_PROFILE:
+            self.line_stats = None
+            for child in self.children:
+                child.ShowLineProfile(None)
+            self.OnExecute(event, profile="lines")
+        else:
+            self.OnExecute(event, profile=True)
+
+    def OnOpenSnapshot(self, event):
+        dlg = wx.FileDialog(
+            self, message="Choose a post-mortem snapshot",
+            defaultDir=os.getcwd(), 
+            wildcard="qdb Snapshots (*.snapshot)|*.snapshot|All Files|*",
+            style=wx.OPEN 
+            )
+        if dlg.ShowModal() == wx.ID_OK:
+            filename = dlg.GetPaths()[0]
+            try:
+                self.debugger.replay(filename)
+            except Exception as e:
+                msg = wx.MessageDialog(self, unicode(e), 
+                        "Unable to load the snapshot", 
+                        wx.OK | wx.ICON_EXCLAMATION)
+                msg.ShowModal()
+                msg.Destroy()
+        dlg.Destroy()
+
+    def OnProfileData(self, event):
+        "Show the (partial) sampling profiler results"
+        self.profile.BuildTree(event.data)
+        pane = self._mgr.GetPane("profile")
+        if not pane.IsShown():
+            pane.Show()
+            self._mgr.Update()
+
+    def OnLineProfileData(self, event):
+        "Show the line profiler results in the editors (heat colouring)"
+        self.line_stats = event.data
+        for child in self.children:
+            self.ShowLineProfile(child)
+
+    def ShowLineProfile(self, child):
+        "Highlight the hot lines of the file (if it was profiled)"
+        if self.line_stats:
+            stats, elapsed = self.line_stats
+            filename = child.GetFilename()
+            if filename:
+                filename = os.path.normcase(os.path.abspath(filename))
+                if filename in stats:
+                    child.ShowLineProfile(stats[filename], elapsed)
+
+    def OnExecute(self, event, debug=True, profile=False):
         if self.active_child and not self.console.process:
             filename = self.active_child.GetFilename()
             cdir, filen = os.path.split(filename)
@@ -838,7 +924,14 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
                 largs = self.lastprogargs and ' ' + self.lastprogargs or ""
                 if wx.Platform == '__WXMSW__':
                     filename = filename.replace("\\", "/")
-                self.Execute((self.pythonexec + " -u " + (debug and self.pythonargs or '') + ' "' + 
+                qdbargs = debug and self.pythonargs or ''
+                if profile == "lines":
+                    # line profiler (lean tracer, no debugger)
+                    qdbargs = self.pythonargs + " --profile=lines"
+                elif profile:
+                    # statistical profiler (qdb backend without tracing)
+                    qdbargs = self.pythonargs + " --profile"
+                self.Execute((self.pythonexec + " -u " + qdbargs + ' "' + 
                     filename + '"'  + largs), filen)
                 self.statusbar.SetStatusText("Executing: %s" % (filename), 1)
             except Exception as e:
@@ -900,9 +993,12 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
             if context:
                 call_stack = context['call_stack']
                 environment = context['environment']
+                watches = context.get('watches', [])
             else:
                 call_stack = environment = {}
+                watches = []
             self.call_stack.BuildList(call_stack)
+            self.watch.BuildList(watches)
             self.environment.BuildTree(environment,
                                        sort_order=('locals', 'globals'))
         elif not running:
@@ -922,6 +1018,17 @@ class PyAUIFrame(aui.AuiMDIParentFrame, PSPMixin, RepoMixin, TaskMixin,
                 else:
                     child.GotoLineOffset(lineno, offset)
 
+    def OnAddWatch(self, event):
+        "Add the selected text (expression) to the watch list"
+        # (it can be done before running, so it is not a debug command)
+        arg = self.active_child and self.active_child.GetSelectedText().strip()
+        if arg:
+            self.watch.AddWatch(arg)
+            pane = self._mgr.GetPane("watch")
+            if not pane.IsShown():
+                pane.Show()
+                self._mgr.Update()
+
     def GetBreakpoints(self):
         if self.temp_breakpoint:
             yield self.temp_breakpoint
@@ -1305,6 +1412,9 @@ class AUIChildFrameEditor(aui.AuiMDIChildFrame):
     def HighlightLines(self, line_numbers, style=0):
         self.editor.HighlightLines(line_numbers)
 
+    def ShowLineProfile(self, stats, elapsed=None):
+        self.editor.ShowLineProfile(stats, elapsed)
+
     def NotifyDefect(self, *args, **kwargs):
         self.parent.NotifyDefect(*args, **kwargs)
 
@@ -1421,6 +1531,9 @@ class AUIChildFrameBrowser(aui.AuiMDIChildFrame):
     def HighlightLines(self, line_numbers, style=0):
         pass
 
+    def ShowLineProfile(self, stats, elapsed=None):
+        pass
+
     def NotifyDefect(self, *args, **kwargs):
         pass
     
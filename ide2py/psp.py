@@ -15,6 +15,11 @@ import os, os.path
 import sys
 import hashlib, uuid
 import cPickle as pickle
+import json
+import time
+import httplib
+import xmlrpclib
+from threading import Thread, Condition
 import wx
 import wx.grid
 from wx.lib.mixins.listctrl import CheckListCtrlMixin, ListCtrlAutoWidthMixin
@@ -39,6 +44,13 @@ PSP_DEFECT_TYPES = {10: 'Documentation', 20: 'Synax', 30: 'Build',
 
 PSP_EVENT_LOG_FORMAT = "%(timestamp)s %(uuid)s %(phase)s %(event)s %(comment)s"
 
+PSP_SYNC_RETRY_DELAY = 5        # seconds to wait after a failed upload
+PSP_SYNC_MAX_DELAY = 300        # maximum delay (exponential backoff)
+# network errors (the upload will be retried, other errors are permanent):
+PSP_SYNC_TRANSPORT_ERRORS = (IOError, httplib.HTTPException, 
+                             xmlrpclib.ProtocolError)
+PSP_FLUSH_DELAY = 30            # seconds of metrics kept in memory (counters)
+
 ID_START, ID_PAUSE, ID_STOP, ID_CHECK, ID_METADATA, ID_DIFF, ID_PHASE, \
 ID_DEFECT, ID_DEL, ID_DEL_ALL, ID_EDIT, ID_FIXED, ID_WONTFIX, ID_FIX, \
 ID_UP, ID_DOWN, ID_WIKI, ID_COMPILE, ID_TEST \
@@ -548,6 +560,50 @@ class DefectDialog(wx.Dialog):
 
 
 
+class PSPSyncWorker(Thread):
+    "Background thread to upload the queued metrics to the remote server"
+
+    def __init__(self, parent, server_url):
+        Thread.__init__(self)
+        self.parent = parent
+        self.rpc_client = simplejsonrpc.ServiceProxy(server_url)
+        self.pending = []           # [(key, sync_queue_id, method, args)]
+        self.condition = Condition()
+        self.setDaemon(True)        # do not wait pending uploads on exit
+        self.start()
+
+    def put(self, key, sync_queue_id, method, args):
+        "Queue a remote call (replacing any pending one with the same key)"
+        with self.condition:
+            self.pending = [item for item in self.pending if item[0] != key]
+            self.pending.append((key, sync_queue_id, method, args))
+            self.condition.notify()
+
+    def run(self):
+        delay = PSP_SYNC_RETRY_DELAY
+        while True:
+            with self.condition:
+                while not self.pending:
+                    self.condition.wait()
+                key, sync_queue_id, method, args = item = self.pending.pop(0)
+            try:
+                getattr(self.rpc_client, method)(*args)
+            except PSP_SYNC_TRANSPORT_ERRORS, e:
+                # keep the call (if not superseded) and retry later:
+                with self.condition:
+                    if not [i for i in self.pending if i[0] == key]:
+                        self.pending.insert(0, item)
+                wx.CallAfter(self.parent.psp_sync_failed, sync_queue_id, e)
+                time.sleep(delay)
+                delay = min(delay * 2, PSP_SYNC_MAX_DELAY)
+            except Exception, e:
+                # rejected by the server (JSONRPCError), do not retry it:
+                wx.CallAfter(self.parent.psp_sync_rejected, sync_queue_id, e)
+            else:
+                wx.CallAfter(self.parent.psp_sync_done, sync_queue_id)
+                delay = PSP_SYNC_RETRY_DELAY
+
+
 class PSPMixin(object):
     "ide2py extension for integrated PSP support"
     
@@ -568,6 +624,11 @@ class PSPMixin(object):
         self.db.create("metadata", metadata_id=int, filename=str, uuid=str,
                        lineno=int, origin=int, phase=str, text=str)
 
+        # outbound queue of remote calls (uploaded in background):
+        self.db.create("sync_queue", sync_queue_id=int, task_name=str,
+                       method=str, params=str, attempts=int, created=str,
+                       error=str)
+
         # text recording logs
         psp_event_log_filename = cfg.get("psp_event_log", "psp_event_log.txt")
         self.psp_event_log_file = open(psp_event_log_filename, "a")
@@ -600,6 +661,13 @@ class PSPMixin(object):
         self.psp_rpc_client = simplejsonrpc.ServiceProxy(cfg.get("server_url"))
         self.psp_wiki_url = cfg.get("wiki_url")
 
+        # upload worker (resume the pending calls of previous sessions)
+        self.psp_sync_worker = PSPSyncWorker(self, cfg.get("server_url"))
+        for row in self.db.select("sync_queue", error=None):
+            self.psp_sync_worker.put((row['task_name'], row['method']),
+                                     row['sync_queue_id'], row['method'],
+                                     json.loads(row['params']))
+
         self.Bind(wx.EVT_CHOICE, self.OnPSPPhaseChoice, self.psp_phase_choice)
         self.SetPSPPhase(cfg.get("current_phase"))
 
@@ -1006,19 +1074,25 @@ class PSPMixin(object):
         if self.task_id:
             task = self.db["task"][self.task_id]
             
-            self.psp_defect_list.data.sync()
-            self.psptimetable.data.sync()
+            self.psp_flush()
             
             if self.psp_rpc_client:
-                pass  ##self.psp_save_project_rpc(task["task_name"]):
+                self.psp_save_project_rpc(task["task_name"])
             return True
 
-    def psp_save_project_rpc(self, task_name):
+    def psp_flush(self):
+        "Write the metrics kept in memory to the database (PSP_FLUSH_DELAY)"
+        for data in (self.psp_defect_list.data, self.psptimetable.data):
+            if data is not None:
+                data.flush()
+
+    def psp_save_project_rpc(self, task_name, actual_loc=None, 
+                             reuse_library_entries=None):
             defects = []
             for defect in self.psp_defect_list.data.values():
-                defect = defect.copy()
+                defect = dict([(k, defect[k]) for k in defect.keys()])
                 defect['date'] = str(defect['date'])
-                del defect['checked']
+                defect.pop('checked', None)
                 defects.append(defect)
             time_summaries = []
             comments = []
@@ -1029,10 +1103,17 @@ class PSPMixin(object):
                     comment = {'phase': phase, 'message': message, 'delta': delta}
                     comments.append(comment)
                 time_summaries.append(time_summary)
-            self.psp_rpc_client.save_project(task['task_name'], 
-                                             defects, 
-                                             time_summaries, 
-                                             comments)
+            # keep the postmortem data of a pending upload (not sent yet):
+            if actual_loc is None:
+                for row in self.db.select("sync_queue", task_name=task_name,
+                                          method="sync_project", error=None):
+                    actual_loc, reuse_library_entries = \
+                        json.loads(row['params'])[4:]
+            # the server only stores the rows that were modified (by uuid)
+            # (metrics and postmortem are sent together, in one round trip)
+            self.psp_sync_call(task_name, "sync_project", task_name, 
+                               defects, time_summaries, comments,
+                               actual_loc, reuse_library_entries)
             return True
 
     def psp_update_project(self, locs, objects):
@@ -1057,22 +1138,59 @@ class PSPMixin(object):
                     "loc": obj[3],
                     }
                 reuse_library_entries.append(entry)
-            self.psp_rpc_client.update_project(task['task_name'], 
-                                               actual_loc,
-                                               reuse_library_entries)
+            self.psp_flush()
+            if self.psp_rpc_client:
+                self.psp_save_project_rpc(task['task_name'], actual_loc,
+                                          reuse_library_entries)
             return True
 
+    def psp_sync_call(self, task_name, method, *args):
+        "Queue a remote call to be sent in background (stored until done)"
+        # coalesce: a new upload replaces the pending ones (full snapshot)
+        self.db.delete("sync_queue", task_name=task_name, method=method)
+        sync_queue_id = self.db.insert("sync_queue", task_name=task_name,
+                                       method=method, params=json.dumps(args),
+                                       attempts=0, 
+                                       created=str(datetime.datetime.now()))
+        self.db.commit()
+        self.psp_sync_worker.put((task_name, method), sync_queue_id, 
+                                 method, args)
+
+    def psp_sync_done(self, sync_queue_id):
+        "Remove the remote call already sent (called from the worker thread)"
+        self.db.delete("sync_queue", sync_queue_id=sync_queue_id)
+        self.db.commit()
+
+    def psp_sync_failed(self, sync_queue_id, error):
+        "Record the failed attempt (it will be retried by the worker thread)"
+        for row in self.db.select("sync_queue", sync_queue_id=sync_queue_id):
+            self.db.update("sync_queue", sync_queue_id=sync_queue_id,
+                           attempts=row['attempts'] + 1)
+            self.db.commit()
+        self.psp_log_event("sync_failed", comment=str(error))
+
+    def psp_sync_rejected(self, sync_queue_id, error):
+        "Keep the remote call that failed permanently (it won't be resent)"
+        self.db.update("sync_queue", sync_queue_id=sync_queue_id, 
+                       error=str(error))
+        self.db.commit()
+        self.psp_log_event("sync_rejected", comment=str(error))
+
     def psp_load_project(self):
         "Receive metrics from remote server (times and defects)"
-        # clean up any previous metrics data:
+        # write the pending changes (i.e. stopwatch) and clean up the data:
+        self.psp_flush()
         self.psp_defect_list.DeleteAllItems()
         self.psptimetable.Clear()
         # fetch and deserialize database internal rows to GUI data structures
         if self.task_id:
             task = self.db["task"][self.task_id]
-            data = DictShelf(self.db, "defect", "uuid", task_id=self.task_id)
+            # stopwatch counters are written to the database in batches
+            data = DictShelf(self.db, "defect", "uuid", 
+                             delay=PSP_FLUSH_DELAY, task_id=self.task_id)
             self.psp_defect_list.Load(data)
-            data = DictShelf(self.db, "time_summary", "phase", task_id=self.task_id)
+            data = DictShelf(self.db, "time_summary", "phase", 
+                             delay=PSP_FLUSH_DELAY, task_id=self.task_id)
             self.psptimetable.Load(data)
             if self.psp_rpc_client:
                 pass ##self.psp_load_project_rpc(task['task_name'])
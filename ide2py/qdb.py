@@ -15,26 +15,82 @@ __version__ = "1.04c"
 # based on idle, inspired by pythonwin implementation, taken many code from pdb
 
 import bdb
+import dis
+import hashlib
 import inspect
 import linecache
+import marshal
 import os
+import re
+import struct
 import sys
 import traceback
 import cmd
 import pydoc
 import threading
+import time
+import zlib
+from collections import deque
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
 
 
 # Speed Ups: global variables
-breaks = []
+breaks = {}             # breakpoints index: {canonic filename: set(lineno)}
+code_breaks = {}        # cache: {(filename, first lineno): lines it can reach}
+CODE_BREAKS_SIZE = 10000 # max cached code locations (web2py recompiles)
+
+
+# multiplexed connections: each message is prefixed with the thread id
+THREAD_TAG = "\x00".encode("ascii")    # not a pickle opcode (plain conn.)
+THREAD_HEADER = struct.Struct("!Q")
+
+# sampling profiler defaults (see Sampler):
+PROFILE_INTERVAL = 0.005    # seconds between stack samples
+PROFILE_PERIOD = 1          # seconds between partial results sent
+
+# post-mortem snapshot limits (see Qdb.take_snapshot):
+SNAPSHOT_FRAMES = 20        # innermost frames of the traceback
+SNAPSHOT_CONTEXT = 5        # source lines before and after the current one
+SNAPSHOT_VARIABLES = 100    # variables per scope (first page)
+
+# remote source transfer (see do_stat and do_read_chunk):
+READ_CHUNK = 64 * 1024      # bytes per message
+
+# interruptions (see Qdb.trace_dispatch):
+POLL_EVENTS = 100           # trace events between checks of the connection
+
+
+def get_code_line_range(code):
+    "Return the first and last line numbers of a code object (not nested)"
+    linenos = [lineno for offset, lineno in dis.findlinestarts(code) if lineno]
+    linenos.append(code.co_firstlineno)
+    return min(linenos), max(linenos)
+
+
+def cached(fn):
+    "Decorator to memoize the results while stopped at the same frame"
+    def cached_fn(self, expression):
+        key = (id(self.frame), self.stops, fn.__name__, expression)
+        try:
+            return self.completions[key]
+        except KeyError:
+            ret = self.completions[key] = fn(self, expression)
+            return ret
+    cached_fn.__name__ = fn.__name__
+    cached_fn.__doc__ = fn.__doc__
+    return cached_fn
 
 
 class Qdb(bdb.Bdb):
     "Qdb Debugger Backend"
 
     def __init__(self, pipe, redirect_stdio=True, allow_interruptions=False,
-                 use_speedups=True, skip=[__name__]):
-        global breaks
+                 use_speedups=True, skip=[__name__],
+                 buffer_size=4096, buffer_time=0.1):
         kwargs = {}
         if sys.version_info > (2, 7):
             kwargs['skip'] = skip
@@ -42,13 +98,15 @@ class Qdb(bdb.Bdb):
         self.frame = None
         self.i = 1  # sequential RPC call id
         self.waiting = False
-        self.pipe = pipe # for communication
+        # for communication (serialize sends from the sampler/timer threads):
+        self.pipe = pipe and LockedPipe(pipe)
         self._wait_for_mainpyfile = False
         self._wait_for_breakpoint = False
         self.mainpyfile = ""
         self._lineno = None     # last listed line numbre
         # ignore filenames (avoid spurious interaction specially on py2)
-        self.ignore_files = [self.canonic(f) for f in (__file__, bdb.__file__)]
+        self.ignore_files = [self.canonic(os.path.splitext(f)[0] + ".py") 
+                             for f in (__file__, bdb.__file__)]
         # replace system standard input and output (send them thru the pipe)
         self.old_stdio = sys.stdin, sys.stdout, sys.stderr
         if redirect_stdio:
@@ -61,10 +119,30 @@ class Qdb(bdb.Bdb):
         self.allow_interruptions = allow_interruptions
         self.burst = 0          # do not send notifications ("burst" mode)
         self.params = {}        # optional parameters for interaction
+        self.snapshot = {}      # last context sent (for incremental updates)
+        self.bp_codes = {}      # breakpoint number: (condition, log) compiled
+        self.watch_codes = {}   # watch expression: compiled code
+        self.stops = 0          # interaction counter (cache invalidation)
+        self.completions = {}   # (frame id, stops, kind, expr): result
+        self.file_stats = {}    # filename: (size, mtime, sha1) already hashed
+        self.announced = {}     # file stats sent to the frontend
+
+        # stdout buffer (coalesce writes by size or time window):
+        self.output = []
+        self.output_size = 0
+        self.output_time = 0    # last time the buffered output was sent
+        self.buffer_size = buffer_size
+        self.buffer_time = buffer_time
+        self.output_lock = threading.Lock()
+        self.flusher = None     # sends the tail of a burst (see Flusher)
+        if redirect_stdio and buffer_time < float("inf"):
+            self.flusher = Flusher(self, buffer_time)
+            self.flusher.start()
         
         # flags to reduce overhead (only stop at breakpoint or interrupt)
         self.use_speedups = use_speedups
         self.fast_continue = False
+        self.poll_countdown = 0     # trace events until the next pipe poll
 
     def pull_actions(self):
         # receive a remote procedure call from the frontend:
@@ -72,6 +150,10 @@ class Qdb(bdb.Bdb):
         #         None when 'run' notification is received (see 'startup')
         request = self.pipe.recv()
         if request.get("method") == 'run':
+            # switch to the serialization negotiated at startup (if any):
+            codec = request.get('args') and CODECS.get(request['args'][0])
+            if codec:
+                self.pipe = CodecPipe(self.pipe, codec())
             return None
         response = {'version': '1.1', 'id': request.get('id'), 
                     'result': None, 
@@ -85,6 +167,7 @@ class Qdb(bdb.Bdb):
             response['error'] = {'code': 0, 'message': str(e)}
         # send the result for normal method calls, not for notifications
         if request.get('id'):
+            self.flush()    # console output (if any) should arrive first
             self.pipe.send(response)
         return True
 
@@ -92,17 +175,21 @@ class Qdb(bdb.Bdb):
 
     def trace_dispatch(self, frame, event, arg):
         # check for non-interaction rpc (set_breakpoint, interrupt)
-        while self.allow_interruptions and self.pipe.poll():
-            self.pull_actions()
-            # check for non-interaction rpc (set_breakpoint, interrupt)
-            while self.pipe.poll():
-                self.pull_actions()
-        if (frame.f_code.co_filename, frame.f_lineno) not in breaks and \
-            self.fast_continue:
-            return self.trace_dispatch
+        # (not on every event: polling the connection is a system call)
+        if self.allow_interruptions:
+            self.poll_countdown -= 1
+            if self.poll_countdown <= 0:
+                self.poll_countdown = POLL_EVENTS
+                while self.pipe.poll():
+                    self.pull_actions()
+        if self.fast_continue:
+            # only trace functions whose code can reach a breakpoint:
+            lines = self.get_code_breaks(frame.f_code)
+            if event == 'call':
+                return lines and self.trace_dispatch or None
+            if event != 'line' or frame.f_lineno not in lines:
+                return self.trace_dispatch
         # process the frame (see Bdb.trace_dispatch)
-        ##if self.fast_continue:
-        ##    return self.trace_dispatch
         if self.quitting:
             return # None
         if event == 'line':
@@ -115,6 +202,95 @@ class Qdb(bdb.Bdb):
             return self.dispatch_exception(frame, arg)
         return self.trace_dispatch
 
+    def get_code_breaks(self, code):
+        "Return the breakpoint lines in the code object range (cached)"
+        # key by location (not the code object itself, to not keep it alive)
+        key = code.co_filename, code.co_firstlineno
+        try:
+            return code_breaks[key]
+        except KeyError:
+            lines = breaks.get(self.canonic(code.co_filename), ())
+            if lines:
+                first, last = get_code_line_range(code)
+                lines = [lineno for lineno in lines if first <= lineno <= last]
+            if len(code_breaks) >= CODE_BREAKS_SIZE:
+                code_breaks.clear()
+            code_breaks[key] = lines = frozenset(lines)
+            return lines
+
+    def update_breaks_index(self):
+        "Rebuild the breakpoints index (call after setting or clearing them)"
+        breaks.clear()
+        code_breaks.clear()
+        for filename, linenos in self.breaks.items():
+            if filename:    # skip the fake breakpoint (allow_interruptions)
+                breaks[filename] = set(linenos)
+        # remove compiled conditions of deleted breakpoints:
+        for number in list(self.bp_codes):
+            if not bdb.Breakpoint.bpbynumber[number]:
+                del self.bp_codes[number]
+
+    def break_here(self, frame):
+        "Check for a breakpoint (like Bdb but using compiled conditions)"
+        filename = self.canonic(frame.f_code.co_filename)
+        if filename not in self.breaks:
+            return False
+        lineno = frame.f_lineno
+        if lineno not in self.breaks[filename]:
+            # The line itself has no breakpoint, but maybe the line is the
+            # first line of a function with breakpoint set by function name.
+            lineno = frame.f_code.co_firstlineno
+            if lineno not in self.breaks[filename]:
+                return False
+        # flag says ok to delete temp. bp
+        (bp, flag) = self.effective(filename, lineno, frame)
+        if bp:
+            self.currentbp = bp.number
+            if (flag and bp.temporary):
+                self.do_clear(str(bp.number))
+            return True
+        else:
+            return False
+
+    def effective(self, filename, lineno, frame):
+        "Return the breakpoint to stop at and the temp. deletion flag"
+        # see bdb.effective, but do not compile the condition on every hit
+        for b in bdb.Breakpoint.bplist[filename, lineno]:
+            if not b.enabled or not bdb.checkfuncname(b, frame):
+                continue
+            b.hits += 1
+            cond, log = self.bp_codes.get(b.number, (None, None))
+            if cond is not None:
+                try:
+                    if not eval(cond, frame.f_globals, frame.f_locals):
+                        continue
+                except:
+                    # if eval fails, most conservative thing is to stop on
+                    # breakpoint regardless of ignore count.
+                    # Don't delete temporary, as another hint to user.
+                    return (b, 0)
+            if b.ignore > 0:
+                # hit count not reached yet
+                b.ignore -= 1
+            elif log is not None:
+                # log point: output the message and never stop
+                self.log_point(log, frame)
+            else:
+                return (b, 1)
+        return (None, None)
+
+    def log_point(self, log, frame):
+        "Write a log point message evaluating the {expressions} (if any)"
+        text = []
+        for i, part in enumerate(log):
+            if i % 2:
+                try:
+                    part = str(eval(part, frame.f_globals, frame.f_locals))
+                except Exception, e:
+                    part = "**exception** %s" % repr(e)
+            text.append(part)
+        self.write("".join(text) + "\n")
+
     def user_call(self, frame, argument_list):
         """This method is called when there is the remote possibility
         that we ever need to stop in this function."""
@@ -150,6 +326,7 @@ class Qdb(bdb.Bdb):
         msg = {'method': 'exception', 
                'args': (title, extype.__name__, exvalue, trace, msg), 
                'id': None}
+        self.flush()
         self.pipe.send(msg)
         self.interaction(frame)
 
@@ -157,16 +334,48 @@ class Qdb(bdb.Bdb):
         try:
             return bdb.Bdb.run(self, code, *args, **kwargs)
         finally:
-            pass
+            self.flush()
 
     def runcall(self, function, interp=None, *args, **kwargs):
         try:
             self.interp = interp
             return bdb.Bdb.runcall(self, function, *args, **kwargs)
         finally:
-            pass
+            self.flush()
+
+    def run_profile(self, cmd, interval=PROFILE_INTERVAL):
+        "Execute without tracing, sampling the stack (statistical profiler)"
+        import __main__
+        sampler = Sampler(self, interval=interval)
+        # the sampler thread sends the buffered output along with the samples
+        # (the main thread still sends readline & exceptions: pipe is locked)
+        buffer_size, buffer_time = self.buffer_size, self.buffer_time
+        self.buffer_size = self.buffer_time = float("inf")
+        sampler.start()
+        try:
+            exec cmd in __main__.__dict__, __main__.__dict__
+        finally:
+            sampler.stop()
+            self.buffer_size, self.buffer_time = buffer_size, buffer_time
+            self.flush()
+
+    def run_line_profile(self, cmd):
+        "Execute with a lean line tracer, send the timing table at exit"
+        import __main__
+        profiler = LineProfiler(self)
+        start = time.time()
+        sys.settrace(profiler.trace_dispatch)
+        try:
+            exec cmd in __main__.__dict__, __main__.__dict__
+        finally:
+            sys.settrace(None)
+            elapsed = time.time() - start
+            self.flush()
+            msg = {'method': 'line_profile', 
+                   'args': (profiler.get_stats(), elapsed), 'id': None}
+            self.pipe.send(msg)
 
-    def _runscript(self, filename):
+    def _runscript(self, filename, profile=None):
         # The script has to run in __main__ namespace (clear it)
         import __main__
         import imp
@@ -186,7 +395,12 @@ class Qdb(bdb.Bdb):
         else:
             statement = 'execfile(%r)' % filename
         self.startup()
-        self.run(statement)
+        if profile == "lines":
+            self.run_line_profile(statement)
+        elif profile:
+            self.run_profile(statement, profile)
+        else:
+            self.run(statement)
 
     def startup(self):
         "Notify and wait frontend to set initial params and breakpoints"
@@ -199,6 +413,11 @@ class Qdb(bdb.Bdb):
             frame = frame.f_back
         args = [__version__, os.getpid(), thread.name, " ".join(sys.argv),
                 frame.f_code.co_filename]
+        # offer faster serialization if the connection can transfer raw bytes:
+        if hasattr(self.pipe.pipe, "send_bytes") and \
+           not isinstance(self.pipe, CodecPipe):
+            args.append(sorted(CODECS))
+        self.snapshot = {}
         self.pipe.send({'method': 'startup', 'args': args})
         while self.pull_actions() is not None:
             pass
@@ -219,9 +438,19 @@ class Qdb(bdb.Bdb):
         if code.co_name != "?":
             message = "%s: %s()" % (message, code.co_name)
 
+        # restore tracing in the callers (skipped by fast continue speedups)
+        caller = frame.f_back
+        while caller:
+            if not caller.f_trace:
+                caller.f_trace = self.trace_dispatch
+            if caller is self.botframe:
+                break
+            caller = caller.f_back
+
         # wait user events 
         self.waiting = True    
         self.frame = frame
+        self.stops += 1
         try:
             while self.waiting:
                 #  sync_source_line()
@@ -238,6 +467,13 @@ class Qdb(bdb.Bdb):
                         kwargs['call_stack'] = self.do_where()
                     if self.params.get('environment'):
                         kwargs['environment'] = self.do_environment()
+                    if self.params.get('delta'):
+                        kwargs = self.get_context_delta(kwargs)
+                    if self.params.get('watches'):
+                        kwargs['watches'] = self.do_watches()
+                    if self.params.get('files'):
+                        kwargs['files'] = self.get_stack_files()
+                    self.flush()
                     self.pipe.send({'method': 'interaction', 'id': None,
                                 'args': (filename, self.frame.f_lineno, line),
                                 'kwargs': kwargs})
@@ -245,8 +481,41 @@ class Qdb(bdb.Bdb):
                 self.pull_actions()
         finally:
             self.waiting = False
+            self.completions.clear()    # resumed, results are not valid
         self.frame = None
 
+    def get_context_delta(self, context):
+        "Return only the changes since the last context sent (and store it)"
+        delta = {}
+        if 'call_stack' in context:
+            # send only the frames after the common prefix (callers):
+            stack = context['call_stack']
+            old_stack = self.snapshot.get('call_stack', [])
+            keep = 0
+            while keep < min(len(stack), len(old_stack)) and \
+                  stack[keep] == old_stack[keep]:
+                keep += 1
+            delta['call_stack_delta'] = (keep, stack[keep:])
+        if 'environment' in context:
+            # send only the added or modified variables, and the removed names
+            delta['environment_delta'] = env_delta = {}
+            old_env = self.snapshot.get('environment', {})
+            for scope, page in context['environment'].items():
+                if not page:
+                    env_delta[scope] = {}
+                    continue
+                old_rows = dict([(row[0], row) for row in 
+                                 old_env.get(scope, {}).get('items', [])])
+                names = set([row[0] for row in page['items']])
+                env_delta[scope] = {'path': page['path'], 
+                    'offset': page['offset'], 'count': page['count'],
+                    'changed': [row for row in page['items'] 
+                                if old_rows.get(row[0]) != row],
+                    'removed': [name for name in old_rows if name not in names],
+                    }
+        self.snapshot.update(context)
+        return delta
+
     def do_debug(self, mainpyfile=None, wait_breakpoint=1):
         self.reset()
         if not wait_breakpoint or mainpyfile:
@@ -338,10 +607,75 @@ class Qdb(bdb.Bdb):
     def do_read(self, filename):
         return open(filename, "Ur").read()
 
-    def do_set_breakpoint(self, filename, lineno, temporary=0, cond=None):
-        global breaks   # list for speedups!
-        breaks.append((filename.replace("\\", "/"), int(lineno)))
-        return self.set_break(filename, int(lineno), temporary, cond)
+    def do_stat(self, filename):
+        "Return (size, mtime, sha1 hex digest) of a file (hash is cached)"
+        st = os.stat(filename)
+        stats = self.file_stats.get(filename)
+        if not stats or stats[:2] != (st.st_size, st.st_mtime):
+            digest = hashlib.sha1()
+            f = open(filename, "rb")
+            try:
+                for chunk in iter(lambda: f.read(READ_CHUNK), b""):
+                    digest.update(chunk)
+            finally:
+                f.close()
+            stats = (st.st_size, st.st_mtime, digest.hexdigest())
+            self.file_stats[filename] = stats
+        return stats
+
+    def do_read_chunk(self, filename, offset=0, size=READ_CHUNK):
+        "Return a block of a file (raw bytes, streaming transfer)"
+        f = open(filename, "rb")
+        try:
+            f.seek(offset)
+            return f.read(size)
+        finally:
+            f.close()
+
+    def get_stack_files(self):
+        "Announce the new or modified source files of the call stack"
+        files = {}
+        seen = set()
+        for frame, lineno in self.get_stack(self.frame, None)[0]:
+            filename = frame.f_code.co_filename
+            if filename in seen or not os.path.exists(filename):
+                continue
+            seen.add(filename)
+            try:
+                stats = self.do_stat(filename)
+            except (IOError, OSError):
+                continue
+            if self.announced.get(filename) != stats:
+                files[filename] = self.announced[filename] = stats
+        return files
+
+    def do_set_breakpoint(self, filename, lineno, temporary=0, cond=None,
+                          hits=None, log=None):
+        # ignore duplicates (breakpoints can be shared between threads)
+        for bp in self.get_breaks(filename, int(lineno)):
+            if (bp.cond, bp.temporary, getattr(bp, "options", (None, None))
+                ) == (cond, temporary, (hits, log)) and bp.enabled:
+                return None
+        # compile the condition and the log message {expressions} once
+        codes = None
+        if cond or log:
+            codes = [cond and compile(cond, "<breakpoint>", "eval"), log]
+            if log:
+                # split: text, expression, text, expression, ..., text
+                codes[1] = re.split(r"\{([^{}]+)\}", log)
+                for i in range(1, len(codes[1]), 2):
+                    codes[1][i] = compile(codes[1][i], "<logpoint>", "eval")
+        ret = self.set_break(filename, int(lineno), temporary, cond)
+        if not ret:
+            bp = self.get_breaks(filename, int(lineno))[-1]
+            bp.options = (hits, log)    # as requested (see duplicates above)
+            if hits:
+                # only stop (or log) when the hit count is reached
+                bp.ignore = int(hits) - 1
+            if codes:
+                self.bp_codes[bp.number] = tuple(codes)
+        self.update_breaks_index()
+        return ret
 
     def do_list_breakpoint(self):
         breaks = []
@@ -354,13 +688,16 @@ class Qdb(bdb.Bdb):
 
     def do_clear_breakpoint(self, filename, lineno):
         self.clear_break(filename, lineno)
+        self.update_breaks_index()
 
     def do_clear_file_breakpoints(self, filename):
         self.clear_all_file_breaks(filename)
+        self.update_breaks_index()
 
     def do_clear(self, arg):
         # required by BDB to remove temp breakpoints!
         err = self.clear_bpbynumber(arg)
+        self.update_breaks_index()
         if err:
             print '*** DO_CLEAR failed', err
 
@@ -374,7 +711,31 @@ class Qdb(bdb.Bdb):
             ret = pydoc.cram(repr(ret), 255)
         return ret
 
+    def do_watches(self):
+        "Evaluate all the watch expressions: [(expr, type, short repr)]"
+        watches = []
+        for expr in self.params.get('watches', ()):
+            try:
+                code = self.watch_codes.get(expr)
+                if code is None:
+                    code = compile(expr, '<watch>', 'eval')
+                    self.watch_codes[expr] = code
+                value = eval(code, self.frame.f_globals, self.frame_locals)
+                watches.append((expr, repr(type(value)), 
+                                pydoc.cram(repr(value), 255)))
+            except Exception, e:
+                watches.append((expr, "", "**exception** %s" % repr(e)))
+        return watches
+
+    def set_watches(self, exprs):
+        "Set the watch expressions (evaluated at each interaction)"
+        self.params['watches'] = list(exprs)
+        if self.frame:
+            return self.do_watches()
+        return []
+
     def do_exec(self, arg, safe=True):
+        self.completions.clear()        # variables could be changed
         if not self.frame:
             ret = RPCError("No current frame available to exec")
         else:
@@ -403,23 +764,91 @@ class Qdb(bdb.Bdb):
             lines.append((filename, lineno, "", "", line, ))
         return lines
 
-    def do_environment(self):
-        "return current frame local and global environment"
+    def do_environment(self, limit=100):
+        "return current frame local and global environment (first page)"
         env = {'locals': {}, 'globals': {}}
-        # converts the frame global and locals to a short text representation:
         if self.frame:
-            for scope, max_length, vars in (
-                    ("locals", 255, self.frame_locals.items()),
-                    ("globals", 20, self.frame.f_globals.items()), ):
-                for (name, value) in vars:
-                    try:
-                        short_repr = pydoc.cram(repr(value), max_length)                    
-                    except Exception as e:
-                        # some objects cannot be represented...
-                        short_repr = "**exception** %s" % repr(e)
-                    env[scope][name] = (short_repr, repr(type(value)))
+            for scope in env:
+                env[scope] = self.do_expand((scope, ), 0, limit)
         return env
 
+    def do_expand(self, path, offset=0, limit=100):
+        "return a page of children variables: (scope, name, index, ...) path"
+        scope = path[0]
+        if scope == "locals":
+            vars, max_length = self.frame_locals, 255
+        else:
+            vars, max_length = self.frame.f_globals, 20
+        if len(path) == 1:
+            # scope variables (only sort names, do not touch the values yet)
+            names = sorted(vars)
+            count = len(names)
+            kind = "attr"
+            children = [(name, vars[name]) 
+                        for name in names[offset:offset+limit]]
+        else:
+            obj = vars[path[1]]
+            for index in path[2:]:
+                obj = self.get_children(obj)[1][index][1]
+            kind, children = self.get_children(obj)
+            count = len(children)
+            children = children[offset:offset+limit]
+            max_length = 255
+        rows = []
+        # converts only the visible values to a short text representation:
+        for index, (key, value) in enumerate(children, offset):
+            if kind == "attr":
+                name = key
+                if len(path) == 1:
+                    index = name    # scope variables are looked up by name
+            elif kind == "item":
+                name = pydoc.cram(repr(key), 40)
+            elif kind == "set":
+                name = "{%d}" % key
+            else:
+                name = "[%d]" % key
+            try:
+                short_repr = pydoc.cram(repr(value), max_length)
+            except Exception as e:
+                # some objects cannot be represented...
+                short_repr = "**exception** %s" % repr(e)
+            try:
+                expandable = bool(self.get_children(value, count_only=True))
+            except Exception:
+                # broken __len__ or __getattr__ (i.e. proxies): do not expand
+                expandable = False
+            rows.append((name, index, repr(type(value)), short_repr, 
+                         expandable))
+        return {'path': tuple(path), 'offset': offset, 'count': count, 
+                'items': rows}
+
+    def get_children(self, obj, count_only=False):
+        "return the kind and the list of children of a container or instance"
+        if isinstance(obj, dict):
+            if count_only:
+                return len(obj)
+            return "item", list(obj.items())
+        elif isinstance(obj, (list, tuple)):
+            if count_only:
+                return len(obj)
+            return "index", list(enumerate(obj))
+        elif isinstance(obj, (set, frozenset)):
+            if count_only:
+                return len(obj)
+            return "set", list(enumerate(obj))
+        elif not (inspect.ismodule(obj) or inspect.isclass(obj) or 
+                  inspect.isroutine(obj)):
+            # instance attributes (if any)
+            attrs = getattr(obj, "__dict__", None)
+            if isinstance(attrs, dict):
+                if count_only:
+                    return len(attrs)
+                return "attr", sorted(attrs.items())
+        if count_only:
+            return 0
+        return None, []
+
+    @cached
     def get_autocomplete_list(self, expression):
         "Return list of auto-completion options for expression"
         try:
@@ -429,6 +858,7 @@ class Qdb(bdb.Bdb):
         else:
             return dir(obj)
     
+    @cached
     def get_call_tip(self, expression):
         "Return list of auto-completion options for expression"
         try:
@@ -528,6 +958,51 @@ class Qdb(bdb.Bdb):
         # send exception information & request interaction
         self.user_exception(frame, info)
 
+    def take_snapshot(self, info=None, frames=SNAPSHOT_FRAMES, 
+                      context=SNAPSHOT_CONTEXT, limit=SNAPSHOT_VARIABLES):
+        "Capture the exception stack, variables and source (plain data)"
+        extype, exvalue, trace = info or sys.exc_info()
+        # pre-process the stack trace (as in user_exception)
+        msg = ''.join(traceback.format_exception(extype, exvalue, trace))
+        title = traceback.format_exception_only(extype, exvalue)[0]
+        entries = [tuple(entry) for entry in traceback.extract_tb(trace)]
+        stack = []
+        while trace is not None:
+            filename = self.canonic(trace.tb_frame.f_code.co_filename)
+            if filename not in self.ignore_files:
+                stack.append((trace.tb_frame, trace.tb_lineno))
+            trace = trace.tb_next
+        main = sys.modules.get("__main__")
+        snapshot = {'version': __version__, 'pid': os.getpid(), 
+                    'thread_name': threading.current_thread().name, 
+                    'argv': " ".join(sys.argv), 'time': time.time(),
+                    'filename': getattr(main, "__file__", ""),
+                    'exception': (title, extype.__name__, repr(exvalue), 
+                                  entries, msg),
+                    'frames': []}
+        # do_environment inspects the current frame (restore it afterwards)
+        current = self.frame, getattr(self, "frame_locals", None)
+        try:
+            for frame, lineno in stack[-frames:]:
+                filename = frame.f_code.co_filename
+                first = max(1, lineno - context)
+                lines = [linecache.getline(filename, i, frame.f_globals) 
+                         for i in range(first, lineno + context + 1)]
+                # only the first page of reprs, the values cannot be expanded
+                self.frame, self.frame_locals = frame, frame.f_locals
+                env = self.do_environment(limit)
+                for page in env.values():
+                    page['items'] = [row[:4] + (False, ) 
+                                     for row in page['items']]
+                snapshot['frames'].append({'filename': self.canonic(filename),
+                                           'lineno': lineno,
+                                           'name': frame.f_code.co_name, 
+                                           'first': first, 'lines': lines,
+                                           'environment': env})
+        finally:
+            self.frame, self.frame_locals = current
+        return snapshot
+
     def ping(self):
         "Minimal method to test that the pipe (connection) is alive"
         try:
@@ -544,6 +1019,7 @@ class Qdb(bdb.Bdb):
     # console file-like object emulation
     def readline(self):
         "Replacement for stdin.readline()"
+        self.flush()    # show the prompt (if any) before asking the input
         msg = {'method': 'readline', 'args': (), 'id': self.i}
         self.pipe.send(msg)
         msg = self.pipe.recv()
@@ -558,15 +1034,40 @@ class Qdb(bdb.Bdb):
         return lines
 
     def write(self, text):
-        "Replacement for stdout.write()"
-        msg = {'method': 'write', 'args': (text, ), 'id': None}
-        self.pipe.send(msg)
+        "Replacement for stdout.write() (buffered, see flush and Flusher)"
+        self.output_lock.acquire()
+        try:
+            self.output.append(text)
+            self.output_size += len(text)
+            full = (self.output_size >= self.buffer_size or 
+                    time.time() - self.output_time >= self.buffer_time)
+        finally:
+            self.output_lock.release()
+        if full:
+            self.flush()
         
     def writelines(self, l):
         map(self.write, l)
 
     def flush(self):
-        pass
+        "Send the buffered output thru the pipe (one message for all writes)"
+        # the profiler and the flusher threads also call it (lock the buffer)
+        self.output_lock.acquire()
+        try:
+            if self.output:
+                output, self.output = self.output, []
+                self.output_size = 0
+                try:
+                    chunks = ["".join(output)]
+                except UnicodeDecodeError:
+                    # mixed unicode and non-ascii str, do not coalesce them
+                    chunks = output
+                for text in chunks:
+                    msg = {'method': 'write', 'args': (text, ), 'id': None}
+                    self.pipe.send(msg)
+            self.output_time = time.time()
+        finally:
+            self.output_lock.release()
 
     def isatty(self):
         return 0
@@ -577,6 +1078,12 @@ class Qdb(bdb.Bdb):
     def close(self):
         # revert redirections and close connection
         sys.stdin, sys.stdout, sys.stderr = self.old_stdio
+        if self.flusher:
+            self.flusher.running = False
+        try:
+            self.flush()
+        except:
+            pass
         try:
             self.pipe.close()
         except:
@@ -608,6 +1115,533 @@ class QueuePipe(object):
         pass
 
 
+class MarshalCodec(object):
+    "Compact binary serialization for the RPC messages (fallback to pickle)"
+
+    # envelope: payload format (1 byte) + (method, id, args, kwargs) tuple
+    # (responses have no method: (None, id, result, error) tuple)
+    MARSHAL, PICKLE = "M".encode("ascii"), "P".encode("ascii")
+
+    def encode(self, msg):
+        "Convert a message (dict) to a string of bytes"
+        if 'method' in msg:
+            envelope = (msg['method'], msg.get('id'), msg.get('args', ()), 
+                        msg.get('kwargs') or {})
+        else:
+            envelope = (None, msg.get('id'), msg.get('result'), 
+                        msg.get('error'))
+        try:
+            return self.MARSHAL + marshal.dumps(envelope)
+        except ValueError:
+            # custom objects (i.e. exception values): try pickle
+            return self.PICKLE + self.pickle(envelope)
+
+    def decode(self, data):
+        "Convert a string of bytes to a message (dict)"
+        if data[:1] == self.MARSHAL:
+            method, id, a, b = marshal.loads(data[1:])
+        else:
+            method, id, a, b = pickle.loads(data[1:])
+        if method is not None:
+            return {'method': method, 'id': id, 'args': a, 'kwargs': b}
+        else:
+            return {'version': '1.1', 'id': id, 'result': a, 'error': b}
+
+    def pickle(self, obj):
+        "Serialize using pickle, replacing the unpicklable objects by repr"
+        try:
+            return pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return pickle.dumps(self.sanitize(obj), pickle.HIGHEST_PROTOCOL)
+
+    def sanitize(self, obj):
+        "Return a copy of the containers with unpicklable values as repr"
+        if isinstance(obj, (tuple, list)):
+            return type(obj)([self.sanitize(item) for item in obj])
+        elif isinstance(obj, dict):
+            return dict([(self.sanitize(key), self.sanitize(value)) 
+                         for key, value in obj.items()])
+        try:
+            pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+            return obj
+        except Exception:
+            return repr(obj)
+
+
+# available serialization formats (name: class), see startup negotiation
+# (marshal is python version specific, so they are not interchangeable)
+CODECS = {"marshal%d" % sys.version_info[0]: MarshalCodec}
+
+
+class LockedPipe(object):
+    "Pipe wrapper to serialize the sends from different threads"
+
+    def __init__(self, pipe):
+        self.pipe = pipe
+        self.lock = threading.Lock()    # C lock (RLock is traced in py2)
+
+    def send(self, data):
+        self.lock.acquire()
+        try:
+            self.pipe.send(data)
+        finally:
+            self.lock.release()
+
+    def send_bytes(self, data):
+        self.lock.acquire()
+        try:
+            self.pipe.send_bytes(data)
+        finally:
+            self.lock.release()
+
+    def recv(self):
+        return self.pipe.recv()
+
+    def recv_bytes(self):
+        return self.pipe.recv_bytes()
+
+    def poll(self, *args):
+        return self.pipe.poll(*args)
+
+    def fileno(self):
+        return self.pipe.fileno()
+
+    def close(self):
+        self.pipe.close()
+
+
+class CodecPipe(object):
+    "Pipe wrapper to serialize the messages using a custom codec"
+
+    def __init__(self, pipe, codec):
+        self.pipe = pipe
+        self.codec = codec
+
+    def send(self, data):
+        self.pipe.send_bytes(self.codec.encode(data))
+
+    def recv(self):
+        return self.codec.decode(self.pipe.recv_bytes())
+
+    def poll(self, *args):
+        return self.pipe.poll(*args)
+
+    def fileno(self):
+        return self.pipe.fileno()
+
+    def close(self):
+        self.pipe.close()
+
+
+class Sampler(threading.Thread):
+    "Statistical profiler: sample the stack of a thread (without tracing)"
+
+    def __init__(self, debugger, ident=None, interval=PROFILE_INTERVAL, 
+                 period=PROFILE_PERIOD):
+        threading.Thread.__init__(self, name="qdb sampler")
+        self.daemon = True
+        self.debugger = debugger
+        self.thread_id = ident or threading.current_thread().ident
+        self.interval = interval
+        self.period = period
+        self.running = False
+        self.labels = {}        # cache: {code object: "filename:lineno:name"}
+        self.stacks = {}        # folded stacks: samples (not sent yet)
+        self.samples = 0
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        last = time.time()
+        while self.running:
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.thread_id)
+            if frame and self.running:
+                self.sample(frame)
+            if time.time() - last >= self.period:
+                self.send()
+                last = time.time()
+
+    def sample(self, frame):
+        "Fold the call stack (root first, skipping the debugger internals)"
+        stack = []
+        ignore = self.debugger.ignore_files
+        while frame:
+            code = frame.f_code
+            label = self.labels.get(code)
+            if label is None:
+                if self.debugger.canonic(code.co_filename) in ignore:
+                    label = ""
+                else:
+                    label = "%s:%s:%s" % (code.co_filename, 
+                                          code.co_firstlineno, code.co_name)
+                self.labels[code] = label
+            if label:
+                stack.append(label)
+            frame = frame.f_back
+        if stack:
+            stack.reverse()
+            key = ";".join(stack)
+            self.stacks[key] = self.stacks.get(key, 0) + 1
+            self.samples += 1
+
+    def send(self):
+        "Send the console output and the samples taken since the last call"
+        stacks, self.stacks = self.stacks, {}
+        samples, self.samples = self.samples, 0
+        self.debugger.flush()
+        if stacks:
+            msg = {'method': 'profile', 'args': (stacks, samples, self.interval),
+                   'id': None}
+            self.debugger.pipe.send(msg)
+
+    def stop(self):
+        "Stop sampling and send the remaining results"
+        self.running = False
+        self.join()
+        self.send()
+
+
+class Flusher(threading.Thread):
+    "Send the buffered console output if no more writes arrive (time limit)"
+
+    def __init__(self, debugger, interval):
+        threading.Thread.__init__(self, name="qdb flusher")
+        self.daemon = True
+        self.debugger = debugger
+        self.interval = interval
+        self.running = False
+
+    def start(self):
+        self.running = True
+        threading.Thread.start(self)
+
+    def run(self):
+        debugger = self.debugger
+        while self.running:
+            time.sleep(self.interval)
+            # buffer_time is infinite while profiling (the sampler flushes)
+            if (self.running and debugger.output and 
+                time.time() - debugger.output_time >= debugger.buffer_time):
+                try:
+                    debugger.flush()
+                except (IOError, EOFError):
+                    self.running = False    # connection lost
+
+
+class LineProfiler(object):
+    "Deterministic profiler: hits and cumulative time of each line"
+
+    def __init__(self, debugger):
+        self.debugger = debugger
+        self.tables = {}        # {code object: (first line, hits, times)}
+        self.timer = time.time
+
+    def trace_dispatch(self, frame, event, arg):
+        "Global trace function: only trace the user code"
+        if event != 'call':
+            return None
+        code = frame.f_code
+        table = self.tables.get(code)
+        if table is None:
+            filename = self.debugger.canonic(code.co_filename)
+            if filename in self.debugger.ignore_files:
+                table = self.tables[code] = False
+            else:
+                # use lists indexed by line number (faster than dicts)
+                first, last = get_code_line_range(code)
+                size = last - first + 1
+                table = self.tables[code] = (first, [0] * size, [0.0] * size)
+        if not table:
+            return None
+        first, hits, times = table
+        timer = self.timer
+        running = [-1, 0.0]     # current line index and start time
+        def trace_line(frame, event, arg):
+            "Local trace function: account the time of the previous line"
+            now = timer()
+            i = running[0]
+            if i >= 0:
+                hits[i] += 1
+                times[i] += now - running[1]
+            if event == 'line':
+                running[0] = frame.f_lineno - first
+                running[1] = now
+            else:
+                running[0] = -1
+            return trace_line
+        return trace_line
+
+    def get_stats(self):
+        "Return the table grouped by file: {filename: {lineno: (hits, secs)}}"
+        stats = {}
+        for code, table in self.tables.items():
+            if not table:
+                continue
+            filename = self.debugger.canonic(code.co_filename)
+            lines = stats.setdefault(filename, {})
+            first, hits, times = table
+            for i, count in enumerate(hits):
+                if count:
+                    # lines can be shared (i.e. comprehensions, lambdas)
+                    prev_hits, prev_time = lines.get(first + i, (0, 0.0))
+                    lines[first + i] = (prev_hits + count, prev_time + times[i])
+        return stats
+
+
+class ThreadMux(object):
+    "Share a connection between the debuggers of several threads"
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.inbox = {}                 # thread id: received messages
+        self.cond = threading.Condition()
+        self.reading = False            # a thread is waiting on the conn
+        self.send_lock = threading.Lock()
+
+    def send_bytes(self, ident, data):
+        header = THREAD_TAG + THREAD_HEADER.pack(ident)
+        self.send_lock.acquire()
+        try:
+            self.conn.send_bytes(header + data)
+        finally:
+            self.send_lock.release()
+
+    def read(self):
+        "Receive a message and store it for its thread (call with cond)"
+        self.reading = True
+        self.cond.release()
+        try:
+            data = self.conn.recv_bytes()
+        finally:
+            self.cond.acquire()
+            self.reading = False
+            self.cond.notify_all()
+        if data[:1] == THREAD_TAG:
+            ident = THREAD_HEADER.unpack(data[1:1 + THREAD_HEADER.size])[0]
+            data = data[1 + THREAD_HEADER.size:]
+            self.inbox.setdefault(ident, deque()).append(data)
+        else:
+            # no thread to deliver it (frontend not multiplexing?)
+            print >> sys.stderr, "qdb: discarded untagged message (%d bytes)" \
+                                 % len(data)
+
+    def recv_bytes(self, ident):
+        self.cond.acquire()
+        try:
+            inbox = self.inbox.setdefault(ident, deque())
+            while not inbox:
+                if self.reading:
+                    # other thread is receiving, wait for its message
+                    self.cond.wait()
+                else:
+                    self.read()
+            return inbox.popleft()
+        finally:
+            self.cond.release()
+
+    def poll(self, ident):
+        self.cond.acquire()
+        try:
+            inbox = self.inbox.setdefault(ident, deque())
+            while not inbox and not self.reading and self.conn.poll():
+                self.read()
+            return bool(inbox)
+        finally:
+            self.cond.release()
+
+    def close(self, ident):
+        "Signal the end of the thread session (empty message)"
+        self.inbox.pop(ident, None)
+        try:
+            self.send_bytes(ident, "".encode("ascii"))
+        except (IOError, EOFError):
+            pass
+
+
+class ThreadPipe(object):
+    "Pipe-like channel of a thread over a multiplexed connection"
+
+    def __init__(self, mux, ident):
+        self.mux = mux
+        self.ident = ident
+
+    def send(self, data):
+        self.send_bytes(pickle.dumps(data, pickle.HIGHEST_PROTOCOL))
+
+    def recv(self):
+        return pickle.loads(self.recv_bytes())
+
+    def send_bytes(self, data):
+        self.mux.send_bytes(self.ident, data)
+
+    def recv_bytes(self):
+        return self.mux.recv_bytes(self.ident)
+
+    def poll(self, *args):
+        return self.mux.poll(self.ident)
+
+    def fileno(self):
+        return self.mux.conn.fileno()
+
+    def close(self):
+        self.mux.close(self.ident)
+
+
+class SnapshotPipe(object):
+    "Read-only backend replaying a post-mortem snapshot (offline session)"
+
+    offline = True
+
+    def __init__(self, snapshot):
+        self.snapshot = snapshot
+        self.frames = snapshot['frames']
+        self.index = len(self.frames) - 1   # current frame (innermost)
+        self.params = {}
+        self.outbox = deque()               # messages for the frontend
+        self.closed = False
+        self.threads = {}
+        args = [snapshot['version'], snapshot['pid'], snapshot['thread_name'],
+                snapshot['argv'], snapshot['filename']]
+        self.outbox.append({'method': 'startup', 'args': args, 'id': None})
+
+    def send(self, request):
+        if request.get('method') == 'run':
+            # startup done: show the exception and stop at the innermost frame
+            self.outbox.append({'method': 'exception', 'id': None,
+                                'args': self.snapshot['exception']})
+            self.interaction()
+            return
+        response = {'version': '1.1', 'id': request.get('id'), 
+                    'result': None, 
+                    'error': None}
+        try:
+            method = getattr(self, request['method'], None)
+            if not method or request['method'] in ("send", "recv", "poll"):
+                raise RPCError("%s is not available in a post-mortem snapshot"
+                               % request['method'])
+            response['result'] = method(*request['args'], 
+                                        **request.get('kwargs', {}))
+        except Exception, e:
+            response['error'] = {'code': 0, 'message': str(e)}
+        if request.get('id'):
+            self.outbox.append(response)
+
+    def recv(self):
+        if not self.outbox:
+            raise EOFError("post-mortem snapshot session finished")
+        return self.outbox.popleft()
+
+    def poll(self, *args):
+        return bool(self.outbox) or self.closed
+
+    def fileno(self):
+        return None
+
+    def close(self):
+        self.closed = True
+
+    def interaction(self):
+        "Send the current frame (as the backend does when stopping)"
+        frame = self.frames[self.index]
+        line = frame['lines'][frame['lineno'] - frame['first']]
+        kwargs = {}
+        if self.params.get('call_stack'):
+            kwargs['call_stack'] = self.do_where()
+        if self.params.get('environment'):
+            kwargs['environment'] = self.do_environment()
+        if self.params.get('watches'):
+            kwargs['watches'] = self.do_watches()
+        self.outbox.append({'method': 'interaction', 'id': None, 
+                            'args': (frame['filename'], frame['lineno'], line),
+                            'kwargs': kwargs})
+
+    # navigation: there is no code to execute, just move thru the stack
+
+    def do_step(self):
+        self.index = min(self.index + 1, len(self.frames) - 1)
+        self.interaction()
+
+    def do_return(self):
+        self.index = max(self.index - 1, 0)
+        self.interaction()
+
+    def do_next(self):
+        self.interaction()
+
+    def do_continue(self):
+        self.closed = True
+
+    do_quit = do_continue
+
+    def do_where(self):
+        return [(frame['filename'], frame['lineno'], "", 
+                 "->" if i == self.index else "",
+                 frame['lines'][frame['lineno'] - frame['first']])
+                for i, frame in enumerate(self.frames)]
+
+    def do_list(self, arg=None):
+        frame = self.frames[self.index]
+        return [(frame['filename'], lineno, "", 
+                 "->" if lineno == frame['lineno'] else "", line)
+                for lineno, line in enumerate(frame['lines'], frame['first'])]
+
+    def do_environment(self):
+        return self.frames[self.index]['environment']
+
+    def do_expand(self, path, offset=0, limit=100):
+        if len(path) > 1:
+            raise RPCError("values were not saved in the snapshot")
+        page = dict(self.do_environment()[path[0]])
+        page['items'] = page['items'][offset:offset+limit]
+        page['offset'] = offset
+        return page
+
+    def do_eval(self, arg):
+        # only variable names can be "evaluated" (their repr was saved)
+        for scope in ("locals", "globals"):
+            for row in self.do_environment()[scope].get('items', []):
+                if row[0] == arg.strip():
+                    return row[3]
+        raise RPCError("cannot evaluate %s in a post-mortem snapshot" % arg)
+
+    def do_watches(self):
+        watches = []
+        for expr in self.params.get('watches', ()):
+            try:
+                watches.append((expr, "", self.do_eval(expr)))
+            except RPCError, e:
+                watches.append((expr, "", "**exception** %s" % e))
+        return watches
+
+    def set_watches(self, exprs):
+        self.params['watches'] = list(exprs)
+        return self.do_watches()
+
+    def do_read(self, filename):
+        return open(filename, "Ur").read()
+
+    def get_autocomplete_list(self, expression):
+        return []
+
+    def get_call_tip(self, expression):
+        return ('', '', '')
+
+    def do_set_breakpoint(self, *args, **kwargs):
+        pass
+
+    do_clear_breakpoint = do_clear_file_breakpoints = do_set_breakpoint
+    interrupt = set_burst = do_set_breakpoint
+
+    def do_list_breakpoint(self):
+        return []
+
+    def set_params(self, params):
+        self.params.update(params)
+
+
 class RPCError(RuntimeError):
     "Remote Error (not user exception)"
     pass
@@ -621,6 +1655,8 @@ class Frontend(object):
         self.info = ()
         self.pipe = pipe
         self.notifies = []
+        self.snapshot = {}      # last context received (see merge_context)
+        self.stacks = {}        # profile results: {folded stack: samples}
         self.read_lock = threading.RLock()
         self.write_lock = threading.RLock()
 
@@ -638,12 +1674,55 @@ class Frontend(object):
         finally:
             self.write_lock.release()
 
-    def startup(self, version, pid, thread_name, argv, filename):
+    def startup(self, version, pid, thread_name, argv, filename, codecs=()):
         self.info = (version, pid, thread_name, argv, filename)
-        self.send({'method': 'run', 'args': (), 'id': None})
+        self.snapshot = {}
+        self.stacks = {}
+        # choose the first serialization format supported by both sides:
+        codecs = [name for name in codecs if name in CODECS]
+        if codecs:
+            self.send({'method': 'run', 'args': (codecs[0], ), 'id': None})
+            self.pipe = CodecPipe(self.pipe, CODECS[codecs[0]]())
+        else:
+            self.send({'method': 'run', 'args': (), 'id': None})
 
     def interaction(self, filename, lineno, line, *kwargs):
         raise NotImplementedError
+
+    def profile(self, stacks, samples, interval):
+        "Accumulate the partial results of the sampling profiler"
+        for stack, count in stacks.items():
+            self.stacks[stack] = self.stacks.get(stack, 0) + count
+
+    def line_profile(self, stats, elapsed):
+        "Receive the line profiler table (at exit)"
+        pass
+
+    def merge_context(self, context):
+        "Apply the incremental changes (deltas) to the last context received"
+        if 'call_stack_delta' in context:
+            keep, stack = context.pop('call_stack_delta')
+            old_stack = self.snapshot.get('call_stack', [])
+            context['call_stack'] = list(old_stack[:keep]) + list(stack)
+        if 'environment_delta' in context:
+            context['environment'] = env = {}
+            old_env = self.snapshot.get('environment', {})
+            for scope, delta in context.pop('environment_delta').items():
+                if not delta:
+                    env[scope] = {}
+                    continue
+                rows = dict([(row[0], row) for row in 
+                             old_env.get(scope, {}).get('items', [])])
+                for name in delta['removed']:
+                    del rows[name]
+                for row in delta['changed']:
+                    rows[row[0]] = row
+                env[scope] = {'path': delta['path'], 
+                              'offset': delta['offset'], 
+                              'count': delta['count'],
+                              'items': [rows[name] for name in sorted(rows)]}
+        self.snapshot.update(context)
+        return context
     
     def exception(self, title, extype, exvalue, trace, request):
         "Show a user_exception"
@@ -683,6 +1762,10 @@ class Frontend(object):
                 self.exception(*request['args'])
             elif request.get('method') == 'write':
                 self.write(*request.get("args"))
+            elif request.get('method') == 'profile':
+                self.profile(*request.get("args"))
+            elif request.get('method') == 'line_profile':
+                self.line_profile(*request.get("args"))
             elif request.get('method') == 'readline':
                 result = self.readline()
             elif request.get('method') == 'ping':
@@ -753,6 +1836,10 @@ class Frontend(object):
         "List all the locals and globals variables (string representation)"
         return self.call('do_environment')
 
+    def do_expand(self, path, offset=0, limit=100):
+        "List a page of the children of a variable (lazy inspection)"
+        return self.call('do_expand', path, offset, limit)
+
     def do_list(self, arg=None):
         "List source code for the current file"
         return self.call('do_list', arg)
@@ -761,9 +1848,19 @@ class Frontend(object):
         "Read and send a local filename"
         return self.call('do_read', filename)
 
-    def do_set_breakpoint(self, filename, lineno, temporary=0, cond=None):
-        "Set a breakpoint at filename:breakpoint"
-        self.call('do_set_breakpoint', filename, lineno, temporary, cond)
+    def do_stat(self, filename):
+        "Get the (size, mtime, sha1) of a remote file"
+        return self.call('do_stat', filename)
+
+    def do_read_chunk(self, filename, offset=0, size=READ_CHUNK):
+        "Read a block of a remote file"
+        return self.call('do_read_chunk', filename, offset, size)
+
+    def do_set_breakpoint(self, filename, lineno, temporary=0, cond=None,
+                          hits=None, log=None):
+        "Set a breakpoint at filename:breakpoint (hit count or log point)"
+        self.call('do_set_breakpoint', filename, lineno, temporary, cond,
+                  hits, log)
 
     def do_clear_breakpoint(self, filename, lineno):
         "Remove a breakpoint at filename:breakpoint"
@@ -800,6 +1897,10 @@ class Frontend(object):
         req = {'method': 'set_params', 'args': (params, )}
         self.send(req)
 
+    def set_watches(self, exprs):
+        "Set the watch expressions, returns their values in the current frame"
+        return self.call('set_watches', list(exprs))
+
 
 class Cli(Frontend, cmd.Cmd):
     "Qdb Front-end command line interface"
@@ -866,7 +1967,7 @@ class Cli(Frontend, cmd.Cmd):
             print "=" * 78
             print key.capitalize()
             print "-" * 78
-            for name, value in env[key].items():
+            for name, index, type_, value, children in env[key].get('items', []):
                 print "%-12s = %s" % (name, value)
 
     def do_list_breakpoint(self, arg=None):
@@ -966,6 +2067,41 @@ def test():
     sys.exit(0)
 
 
+def benchmark(count=10000):
+    "Measure messages/sec thru a pipe for each serialization format"
+    from multiprocessing import Pipe
+    stack = [(__file__, i, "", "", "    x = y + %d\n" % i) for i in range(10)]
+    rows = [("var%d" % i, "var%d" % i, "<type 'int'>", str(i), False) 
+            for i in range(20)]
+    page = {'path': ('locals', ), 'offset': 0, 'count': 20, 'items': rows}
+    traffic = {
+        'step': [{'method': 'do_step', 'args': (), 'id': 1},
+                 {'version': '1.1', 'id': 1, 'result': None, 'error': None}],
+        'write': [{'method': 'write', 'args': ("hello world!\n", ), 
+                   'id': None}],
+        'interaction': [{'method': 'interaction', 'id': None, 
+                         'args': (__file__, 1, "import bdb\n"),
+                         'kwargs': {'call_stack': stack, 
+                                    'environment': {'locals': page}}}],
+        }
+    for name in ["pickle"] + sorted(CODECS):
+        for kind, messages in sorted(traffic.items()):
+            front_conn, child_conn = Pipe()
+            if name in CODECS:
+                front_conn = CodecPipe(front_conn, CODECS[name]())
+                child_conn = CodecPipe(child_conn, CODECS[name]())
+            t0 = time.time()
+            for i in xrange(count):
+                for msg in messages:
+                    front_conn.send(msg)
+                    child_conn.recv()
+            t1 = time.time()
+            print "%-10s %-12s %10.0f msg/s" % (name, kind, 
+                                            count * len(messages) / (t1 - t0))
+            front_conn.close()
+            child_conn.close()
+
+
 def start(host="localhost", port=6000, authkey='secret password'):
     "Start the CLI server and wait connection from a running debugger backend"
     
@@ -984,11 +2120,11 @@ def start(host="localhost", port=6000, authkey='secret password'):
         conn.close()
 
 
-def main(host='localhost', port=6000, authkey='secret password'):
+def main(host='localhost', port=6000, authkey='secret password', profile=None):
     "Debug a script (running under the backend) and connect to remote frontend"
     
     if not sys.argv[1:] or sys.argv[1] in ("--help", "-h"):
-        print "usage: pdb.py scriptfile [arg] ..."
+        print "usage: pdb.py [--profile[=interval|lines]] scriptfile [arg] ..."
         sys.exit(2)
 
     mainpyfile =  sys.argv[1]     # Get script filename
@@ -1005,7 +2141,7 @@ def main(host='localhost', port=6000, authkey='secret password'):
     init(host, port, authkey)
     try:
         print "running", mainpyfile
-        qdb._runscript(mainpyfile)
+        qdb._runscript(mainpyfile, profile)
         print "The program finished"
     except SystemExit:
         # In most cases SystemExit does not warrant a post-mortem session.
@@ -1019,17 +2155,24 @@ def main(host='localhost', port=6000, authkey='secret password'):
         qdb.post_mortem(info)
         print "Program terminated!"
     finally:
+        qdb.flush()
         conn.close()
         print "qdb debbuger backend: connection closed"
 
 
 # "singleton" to store a unique backend per process
 qdb = None
+listener = conn = None
+
+# backends for other threads, multiplexed over the same connection
+mux = None
+debuggers = {}          # thread id: Qdb instance (see thread_trace)
 
 
-def init(host='localhost', port=6000, authkey='secret password', redirect=True):
+def init(host='localhost', port=6000, authkey='secret password', redirect=True,
+         threads=False):
     "Simplified interface to debug running programs"
-    global qdb, listener, conn
+    global qdb, listener, conn, mux
     
     # destroy the debugger if the previous connection is lost (i.e. broken pipe)
     if qdb and not qdb.ping():
@@ -1043,12 +2186,93 @@ def init(host='localhost', port=6000, authkey='secret password', redirect=True):
         print "qdb debugger backend: waiting for connection to", address
         conn = Client(address, authkey=authkey)
         print 'qdb debugger backend: connected to', address
+        pipe = conn
+        if threads:
+            # each thread will have its own session over this connection
+            mux = ThreadMux(conn)
+            pipe = ThreadPipe(mux, threading.current_thread().ident)
+            threading.settrace(thread_trace)
         # create the backend
-        qdb = Qdb(conn, redirect_stdio=redirect, allow_interruptions=True)
+        qdb = Qdb(pipe, redirect_stdio=redirect, allow_interruptions=True)
         # initial hanshake
         qdb.startup()
 
 
+def thread_trace(frame, event, arg):
+    "Trace hook for new threads: start a debugger if breakpoints are reached"
+    if not qdb or not mux:
+        sys.settrace(None)
+        return None
+    if not qdb.get_code_breaks(frame.f_code):
+        # do not trace this function (keep checking the next calls)
+        return None
+    thread = threading.current_thread()
+    ident = thread.ident
+    dbg = Qdb(ThreadPipe(mux, ident), redirect_stdio=False, 
+              allow_interruptions=True)
+    # share the breakpoints (so they can be set/cleared from any session)
+    dbg.breaks, dbg.bp_codes = qdb.breaks, qdb.bp_codes
+    debuggers[ident] = dbg
+    # close the session as soon as the thread finishes:
+    closer = threading.Thread(target=close_thread_session, 
+                              args=(thread, dbg), name="qdb session closer")
+    closer.daemon = True
+    closer.start()
+    dbg.startup()
+    # start tracing from the thread entry point, only stop at breakpoints:
+    dbg.reset()
+    dbg.botframe = frame
+    while dbg.botframe.f_back:
+        dbg.botframe = dbg.botframe.f_back
+    dbg.do_continue()
+    sys.settrace(dbg.trace_dispatch)
+    return dbg.trace_dispatch(frame, event, arg)
+
+
+def close_thread_session(thread, dbg):
+    "Wait the thread to finish and close its debugger (see thread_trace)"
+    thread.join()
+    # the thread id may be reused by a new thread, or quit already closed it
+    if debuggers.get(thread.ident) is dbg:
+        del debuggers[thread.ident]
+        dbg.close()
+
+
+def save_snapshot(filename, info=None):
+    "Write a post-mortem snapshot of the exception (no frontend needed)"
+    dbg = qdb or Qdb(None, redirect_stdio=False)
+    # plain data only: marshal cannot run code when loading (unlike pickle)
+    data = zlib.compress(marshal.dumps(dbg.take_snapshot(info), 2))
+    f = open(filename, "wb")
+    try:
+        f.write(data)
+    finally:
+        f.close()
+
+
+def load_snapshot(filename):
+    "Read a post-mortem snapshot (to be replayed thru a SnapshotPipe)"
+    f = open(filename, "rb")
+    try:
+        return marshal.loads(zlib.decompress(f.read()))
+    finally:
+        f.close()
+
+
+def snapshot_hook(filename=None):
+    "Save a snapshot on unhandled exceptions (install sys.excepthook)"
+    if filename is None:
+        filename = os.path.abspath("qdb-%d.snapshot" % os.getpid())
+    previous_hook = sys.excepthook
+    def excepthook(extype, exvalue, trace):
+        try:
+            save_snapshot(filename, (extype, exvalue, trace))
+        except Exception, e:
+            print >> sys.stderr, "qdb: unable to save the snapshot:", e
+        previous_hook(extype, exvalue, trace)
+    sys.excepthook = excepthook
+
+
 def set_trace(host='localhost', port=6000, authkey='secret password'):
     "Simplified interface to start debugging immediately"
     init(host, port, authkey)
@@ -1058,9 +2282,15 @@ def set_trace(host='localhost', port=6000, authkey='secret password'):
 
 def quit():
     "Remove trace and quit"
-    global qdb, listener, conn
+    global qdb, listener, conn, mux
+    if mux:
+        threading.settrace(None)
+        for ident in list(debuggers):
+            debuggers.pop(ident).close()
+        mux = None
     if qdb:
         sys.settrace(None)
+        qdb.flush()
         qdb = None
     if conn:
         conn.close()
@@ -1073,13 +2303,30 @@ if __name__ == '__main__':
     # When invoked as main program:
     if '--test1' in sys.argv:
         test()
+    if '--bench' in sys.argv:
+        benchmark()
+        sys.exit(0)
     # Check environment for configuration parameters:
     kwargs = {}
     for param in 'host', 'port', 'authkey':
        if 'QDB_%s' % param.upper() in os.environ:
             kwargs[param] = os.environ['QDB_%s' % param.upper()]
 
+    # sampling profiler mode (--profile or --profile=interval in seconds)
+    # or line profiler mode (--profile=lines)
+    for arg in sys.argv[1:2]:
+        if arg.startswith("--profile"):
+            sys.argv.remove(arg)
+            value = arg.partition("=")[2]
+            if value != "lines":
+                value = float(value or PROFILE_INTERVAL)
+            kwargs['profile'] = value
+
     if not sys.argv[1:]:
+        if 'profile' in kwargs:
+            # the profilers run a script (they can't attach to a debugger)
+            print "usage: pdb.py [--profile[=interval|lines]] scriptfile [arg] ..."
+            sys.exit(2)
         # connect to a remote debbuger
         start(**kwargs)
     else:
@@ -21,6 +21,7 @@ __version__ = "0.05"
 import urllib
 from xmlrpclib import Transport, SafeTransport
 from cStringIO import StringIO
+import itertools
 import random
 import sys
 try:
@@ -85,6 +86,7 @@ class ServerProxy(object):
         self.exceptions = True          # raise errors? (JSONRPCError)
         self.timeout = None
         self.json_request = self.json_response = ''
+        self.request_ids = itertools.count(random.randint(0, sys.maxint))
 
         type, uri = urllib.splittype(uri)
         if type not in ("http", "https"):
@@ -108,7 +110,7 @@ class ServerProxy(object):
         "JSON RPC communication (method invocation)"
 
         # build data sent to the service
-        request_id = random.randint(0, sys.maxint)
+        request_id = self.request_ids.next()
         data = {'id': request_id, 'method': method, 'params': args, }
         request = json.dumps(data)
 
@@ -1,19 +1,27 @@
 # coding: utf8
 # try something like
 
-from statistics import calc_correlation, calc_significance, calc_linear_regression, calc_student_t_probability, calc_prediction_interval
+from statistics import RegressionStats, calc_student_t_probability
 from draws import draw_linear_regression
 
    
 def get_projects_metrics():
     "Query size and time metrics series summarized by project"
+    build_projects_metrics()
     q = db.psp_project.completed!=None     # only account finished ones!
-    rows = db(q & (db.psp_project.actual_loc!=None)).select(db.psp_project.actual_loc, orderby=db.psp_project.project_id)
-    actual_loc = [row.actual_loc for row in rows]
-    rows = db(q & (db.psp_project.project_id==db.psp_time_summary.project_id)).select(db.psp_time_summary.actual.sum().with_alias("total"), groupby=db.psp_project.project_id, orderby=db.psp_project.project_id)
-    hours = [row.total/60.0/60.0 for row in rows]
+    q &= db.psp_project.project_id==db.psp_project_metrics.project_id
+    q &= db.psp_project.actual_loc!=None
+    q &= db.psp_project_metrics.actual>0
+    rows = db(q).select(db.psp_project.actual_loc, db.psp_project_metrics.actual, orderby=db.psp_project.project_id)
+    actual_loc = [row.psp_project.actual_loc for row in rows]
+    hours = [row.psp_project_metrics.actual/60.0/60.0 for row in rows]
     return actual_loc, hours
 
+def get_regression_stats():
+    "Query the metrics and accumulate their sums once (for all the estimates)"
+    actual_loc, hours = get_projects_metrics()
+    return actual_loc, hours, RegressionStats(actual_loc, hours)
+
 def correlation():
     "Check correlation between actual object LOC and hours"
     # according [HUMPHREY95] p.513 & p.151:
@@ -21,8 +29,8 @@ def correlation():
     # - when 0.7 <= r2 < 0.9 : there is a strong correlation
     # - when 0.5 <= r2 < 0.7 : there is an adequate correlation (use with caution)
     # - when r2 < 0.5 : not reliable for planning purposes
-    actual_loc, hours = get_projects_metrics()
-    r = calc_correlation(actual_loc, hours)
+    actual_loc, hours, stats = get_regression_stats()
+    r = stats.correlation()
     r2 = r**2
     if 0.9 <= r2:
         corr = 'high (predictive)'
@@ -39,8 +47,8 @@ def significance():
     #TODO: test probability with student t
     # p = student_t(n-1, t) 
     # if 1-p<=0.05 data is considered good [HUMPHREY95] p.70 
-    actual_loc, hours = get_projects_metrics()
-    t, r2, n = calc_significance(actual_loc, hours)
+    actual_loc, hours, stats = get_regression_stats()
+    t, r2, n = stats.significance()
     p = calc_student_t_probability(t, n-1)
     
     s = 1 - p
@@ -60,15 +68,13 @@ def significance():
 
 def get_time_todate():    
     "Calculate accumulated time per phase to date"    
-    q = db.psp_project.project_id==db.psp_time_summary.project_id
+    build_projects_metrics()
+    q = db.psp_project.project_id==db.psp_project_metrics.project_id
     q &= db.psp_project.completed!=None     # only account finished ones!
-    rows = db(q).select(
-            db.psp_time_summary.actual.sum().with_alias("subtotal"),
-            db.psp_time_summary.phase,
-            groupby=db.psp_time_summary.phase)
-    total = float(sum([row.subtotal or 0 for row in rows], 0))
-    todate = sorted([(row.psp_time_summary.phase, row.subtotal or 0, (row.subtotal or 0)/total*100.0) for row in rows],
-                    key=lambda x: PSP_PHASES.index(x[0]))
+    rows = db(q).select(db.psp_project_metrics.ALL)
+    subtotals = [(phase, sum([row["actual_%s" % phase] for row in rows], 0)) for phase in PSP_PHASES]
+    total = float(sum([subtotal for phase, subtotal in subtotals], 0))
+    todate = [(phase, subtotal, subtotal/total*100.0) for phase, subtotal in subtotals if subtotal]
     return todate
 
 def time_in_phase():
@@ -97,8 +103,8 @@ def index():
     if form.accepts(request.vars, session):
     
         # calculate regression parameters for historical LOC and tiem data:
-        actual_loc, hours = get_projects_metrics()
-        b0, b1 = calc_linear_regression(actual_loc, hours)
+        actual_loc, hours, stats = get_regression_stats()
+        b0, b1 = stats.linear_regression()
 
         # get LOC planned size and calculate development time
         size_k = form.vars.size
@@ -146,8 +152,8 @@ def update_plan():
                                        )
 
     # calculate regression parameters and prediction interval for historical LOC and tiem data:
-    actual_loc, hours = get_projects_metrics()
-    b0, b1, p_range, upi, lpi, t = calc_prediction_interval(actual_loc, hours, estimated_loc, estimated_time, alpha)
+    actual_loc, hours, stats = get_regression_stats()
+    b0, b1, p_range, upi, lpi, t = stats.prediction_interval(estimated_loc, estimated_time, alpha)
 
     # update planned loc and time prediction interval:
     db(db.psp_project.project_id==project_id).update(
@@ -156,6 +162,7 @@ def update_plan():
             time_lpi=lpi,
             time_upi=upi,
             )
+    update_project_metrics(project_id)
     # show project summary
     redirect(URL(c='projects', f='show', args=("psp_project", project_id)))
 
@@ -9,7 +9,8 @@ def search():
     return dict(form=form, table=table)
     
 def create(): 
-    return dict(form=crud.create(db.psp_project))
+    onaccept = lambda form: update_project_metrics(form.vars.id)
+    return dict(form=crud.create(db.psp_project, onaccept=onaccept))
     
 def show():
     project_id = request.args[1]
@@ -35,4 +36,7 @@ def show():
     return dict(project=project, form=form, times=times, defects=defects)
 
 def edit():
-    return dict(form=crud.update(db.psp_project, request.args[1]))
+    # keep the summarized metrics (size) up to date:
+    onaccept = lambda form: update_project_metrics(form.vars.id)
+    return dict(form=crud.update(db.psp_project, request.args[1],
+                                 onaccept=onaccept))
@@ -4,60 +4,43 @@
 def index():
     "Calculate performance indicators"
 
-    # Gather metrics:
+    # Gather metrics (materialized per project):
+    build_projects_metrics()
     
-    # Get total LOCs and Times
+    # Get total LOCs and Times (per phase)
     
     q = db.psp_project.completed!=None     # only account finished ones!
-
-    total_loc = db(q).select(
-            db.psp_project.actual_loc.sum().with_alias("actual_loc_sum"),
-            ).first().actual_loc_sum
-
-    # Get times per phase
-    q &= db.psp_project.project_id==db.psp_time_summary.project_id
-    rows = db(q).select(
-            db.psp_time_summary.actual.sum().with_alias("sum_actual"),
-            db.psp_time_summary.plan.sum().with_alias("sum_plan"),
-            db.psp_time_summary.plan.sum().with_alias("sum_interruption"),
-            db.psp_time_summary.phase,
-            groupby=db.psp_time_summary.phase)
-    total_time = float(sum([row.sum_actual or 0 for row in rows], 0))
-    times_per_phase = dict([(row.psp_time_summary.phase, row.sum_actual or 0) for row in rows])
-    planned_time_per_phase = dict([(row.psp_time_summary.phase, row.sum_plan or 0) for row in rows])
-    planned_time = float(sum([row.sum_plan or 0 for row in rows], 0))
+    q &= db.psp_project.project_id==db.psp_project_metrics.project_id
+    rows = db(q).select(db.psp_project_metrics.ALL)
+
+    total_loc = sum([row.actual_loc or 0 for row in rows], 0)
+    total_time = float(sum([row.actual for row in rows], 0))
+    times_per_phase = dict([(phase, sum([row["actual_%s" % phase] for row in rows], 0)) for phase in PSP_PHASES])
+    planned_time_per_phase = dict([(phase, sum([row["plan_%s" % phase] for row in rows], 0)) for phase in PSP_PHASES])
+    planned_time = float(sum([row.plan for row in rows], 0))
     if total_time:
         cost_performance_index = planned_time / total_time
     else:
         cost_performance_index = 0
-    interruption_time = float(sum([row.sum_interruption or 0 for row in rows], 0))
-
-    # Get interruption time
-    q &= db.psp_project.planned_time!=None
-    rows = db(q).select(
-            db.psp_time_summary.actual.sum().with_alias("subtotal"),
-            )
-    actual_time = float(sum([row.subtotal or 0 for row in rows], 0))
-
+    interruption_time = float(sum([row.interruption for row in rows], 0))
     
     # get defects per phase
     q = db.psp_project.completed!=None     # only account finished ones!
-    q &= db.psp_project.project_id==db.psp_defect.project_id
-    q &= db.psp_defect.type != 30     # ignore coding standard violations
-    q &= db.psp_defect.remove_phase != ''     # ignore won't fix defects
+    q &= db.psp_project.project_id==db.psp_defect_metrics.project_id
+    q &= db.psp_defect_metrics.type != 30     # ignore coding standard violations
     rows = db(q).select(
-            db.psp_defect.id.count().with_alias("quantity"),
-            db.psp_defect.fix_time.sum().with_alias("subtotal_fix_time"),
-            db.psp_defect.inject_phase,
-            db.psp_defect.remove_phase,
-            groupby=(db.psp_defect.inject_phase,
-                     db.psp_defect.remove_phase,))
+            db.psp_defect_metrics.quantity.sum().with_alias("quantity"),
+            db.psp_defect_metrics.fix_time.sum().with_alias("subtotal_fix_time"),
+            db.psp_defect_metrics.inject_phase,
+            db.psp_defect_metrics.remove_phase,
+            groupby=(db.psp_defect_metrics.inject_phase,
+                     db.psp_defect_metrics.remove_phase,))
     defects_injected_per_phase = dict([(phase, 0) for phase in PSP_PHASES])
     defects_removed_per_phase = dict([(phase, 0) for phase in PSP_PHASES])
     total_fix_time = 0
     for row in rows:
-        defects_injected_per_phase[row.psp_defect.inject_phase] += row.quantity
-        defects_removed_per_phase[row.psp_defect.remove_phase] += row.quantity
+        defects_injected_per_phase[row.psp_defect_metrics.inject_phase] += row.quantity
+        defects_removed_per_phase[row.psp_defect_metrics.remove_phase] += row.quantity
         total_fix_time += row.subtotal_fix_time
     
         
@@ -155,14 +138,14 @@ def defects():
     "Defect Type Standard"
    
     # get defects per type
+    build_projects_metrics()
     q = db.psp_project.completed!=None     # only account finished ones!
-    q &= db.psp_project.project_id==db.psp_defect.project_id
-    q &= db.psp_defect.remove_phase != ''     # ignore won't fix defects
+    q &= db.psp_project.project_id==db.psp_defect_metrics.project_id
     rows = db(q).select(
-            db.psp_defect.id.count().with_alias("quantity"),
-            db.psp_defect.fix_time.sum().with_alias("subtotal_fix_time"),
-            db.psp_defect.type.with_alias("defect_type"),
-            groupby=(db.psp_defect.type,))
+            db.psp_defect_metrics.quantity.sum().with_alias("quantity"),
+            db.psp_defect_metrics.fix_time.sum().with_alias("subtotal_fix_time"),
+            db.psp_defect_metrics.type.with_alias("defect_type"),
+            groupby=(db.psp_defect_metrics.type,))
     total_fix_time = 0
     defect_count_per_type = dict([(t, 0) for t in PSP_DEFECT_TYPES])
     defect_fix_time_per_type = dict([(t, 0) for t in PSP_DEFECT_TYPES])
@@ -200,14 +183,14 @@ def pareto_distribution():
     from draws import draw_barchart
 
     # get defects per type by remove_phase
+    build_projects_metrics()
     q = db.psp_project.completed!=None     # only account finished ones!
-    q &= db.psp_project.project_id==db.psp_defect.project_id
-    q &= db.psp_defect.remove_phase != ''     # ignore won't fix defects
+    q &= db.psp_project.project_id==db.psp_defect_metrics.project_id
     rows = db(q).select(
-            db.psp_defect.id.count().with_alias("quantity"),
-            db.psp_defect.type.with_alias("defect_type"),
-            db.psp_defect.remove_phase.with_alias("remove_phase"),
-            groupby=(db.psp_defect.type, db.psp_defect.remove_phase))
+            db.psp_defect_metrics.quantity.sum().with_alias("quantity"),
+            db.psp_defect_metrics.type.with_alias("defect_type"),
+            db.psp_defect_metrics.remove_phase.with_alias("remove_phase"),
+            groupby=(db.psp_defect_metrics.type, db.psp_defect_metrics.remove_phase))
     # dict: (defect_type: [missed, found]
     defect_count_per_type = dict([(t, [0, 0]) for t in PSP_DEFECT_TYPES])
     defect_count = 0
@@ -254,15 +237,15 @@ def average_fix_time():
     from draws import draw_barchart, get_colours
 
     # get defects per type by remove_phase
+    build_projects_metrics()
     q = db.psp_project.completed!=None     # only account finished ones!
-    q &= db.psp_project.project_id==db.psp_defect.project_id
-    q &= db.psp_defect.remove_phase != ''     # ignore won't fix defects
+    q &= db.psp_project.project_id==db.psp_defect_metrics.project_id
     rows = db(q).select(
-            db.psp_defect.id.count().with_alias("quantity"),
-            db.psp_defect.type.with_alias("defect_type"),
-            db.psp_defect.fix_time.sum().with_alias("subtotal_fix_time"),
-            db.psp_defect.remove_phase.with_alias("remove_phase"),
-            groupby=(db.psp_defect.type, db.psp_defect.remove_phase))
+            db.psp_defect_metrics.quantity.sum().with_alias("quantity"),
+            db.psp_defect_metrics.type.with_alias("defect_type"),
+            db.psp_defect_metrics.fix_time.sum().with_alias("subtotal_fix_time"),
+            db.psp_defect_metrics.remove_phase.with_alias("remove_phase"),
+            groupby=(db.psp_defect_metrics.type, db.psp_defect_metrics.remove_phase))
     # dict: (defect_type: [missed, found]
     fixtime_per_phase_per_type = dict([(t, dict([(p, 0) for p in PSP_PHASES])) for t in PSP_DEFECT_TYPES])
     defect_count_per_type = dict([(t, 0) for t in PSP_DEFECT_TYPES])
@@ -301,13 +284,15 @@ def average_fix_time():
 
 def projects():
 
-    q = db.psp_project.project_id==db.psp_time_summary.project_id
+    build_projects_metrics()
+    q = db.psp_project.project_id==db.psp_project_metrics.project_id
     rows = db(q).select(
-            db.psp_time_summary.actual.sum().with_alias("sum_actual"),
-            db.psp_time_summary.plan.sum().with_alias("sum_plan"),
-            db.psp_time_summary.plan.sum().with_alias("sum_interruption"),
-            db.psp_project.ALL,
-            groupby=db.psp_project.ALL)
+            db.psp_project_metrics.actual.with_alias("sum_actual"),
+            db.psp_project_metrics.plan.with_alias("sum_plan"),
+            db.psp_project_metrics.interruption.with_alias("sum_interruption"),
+            db.psp_project_metrics.defects.with_alias("quantity"),
+            db.psp_project_metrics.fix_time.with_alias("subtotal_fix_time"),
+            db.psp_project.ALL)
     total_time = float(sum([row.sum_actual or 0 for row in rows], 0))
     planned_time = float(sum([row.sum_plan or 0 for row in rows], 0))
     interruption_time = float(sum([row.sum_interruption or 0 for row in rows], 0))
@@ -315,20 +300,14 @@ def projects():
     projects = rows
 
     # get defects per project
-    q = db.psp_project.project_id==db.psp_defect.project_id
-    q &= db.psp_defect.remove_phase != ''     # ignore won't fix defects
-    rows = db(q).select(
-            db.psp_defect.id.count().with_alias("quantity"),
-            db.psp_defect.fix_time.sum().with_alias("subtotal_fix_time"),
-            db.psp_defect.project_id.with_alias("project_id"),
-            groupby=(db.psp_defect.project_id,))
     total_fix_time = 0
     defects_per_project = {}
     fix_time_per_project = {}
     for row in rows:
-        defects_per_project[row.project_id] = defects_per_project.get(row.project_id, 0) + int(row.quantity)
-        fix_time_per_project[row.project_id] = fix_time_per_project.get(row.project_id, 0) + float(row.subtotal_fix_time)
-        total_fix_time += row.subtotal_fix_time
+        if row.quantity:
+            defects_per_project[row.psp_project.project_id] = int(row.quantity)
+            fix_time_per_project[row.psp_project.project_id] = float(row.subtotal_fix_time)
+            total_fix_time += row.subtotal_fix_time
     defect_count = sum(defects_per_project.values())
 
 
@@ -1,6 +1,7 @@
 # coding: utf8
 # try something like
 
+import datetime
 from gluon.tools import Service
 service = Service(globals())
 
@@ -24,38 +25,110 @@ def get_projects():
     projects = db(db.psp_project.project_id>0).select()
     return [project.name for project in projects]
 
+def get_value(field, value):
+    "Convert a value to the field type (JSON doesn't preserve types)"
+    if value is None:
+        return None
+    elif field.type == 'integer' or field.type.startswith('reference'):
+        return int(value)
+    elif field.type == 'double':
+        return float(value)
+    elif field.type == 'date':
+        return datetime.datetime.strptime(str(value)[:10], "%Y-%m-%d").date()
+    elif isinstance(value, unicode):
+        return value.encode("utf8")
+    else:
+        return str(value)
+
+def get_changes(table, row, values):
+    "Compare the stored record with the uploaded values, return the differences"
+    changes = {}
+    for name, value in values.items():
+        if get_value(table[name], row[name]) != get_value(table[name], value):
+            changes[name] = value
+    return changes
+
+def upsert_rows(table, project_id, rows, key):
+    "Insert, update or delete the rows of a project (by key), return changes"
+    # group the stored rows by key (they could be repeated, i.e. comments)
+    existing = {}
+    for row in db(table.project_id==project_id).select(orderby=table.id):
+        row_key = tuple([get_value(table[k], row[k]) for k in key])
+        existing.setdefault(row_key, []).append(row)
+    new_rows = []
+    changed = []
+    for values in rows:
+        # only store known fields (ignore GUI implementation details)
+        values = dict([(k, v) for k, v in values.items() 
+                       if k in table.fields and k != 'id'])
+        values['project_id'] = project_id
+        # match each uploaded row with one stored row (if any)
+        row_key = tuple([get_value(table[k], values.get(k)) for k in key])
+        matches = existing.get(row_key)
+        if not matches:
+            new_rows.append(values)
+        else:
+            row = matches.pop(0)
+            changes = get_changes(table, row, values)
+            if changes:
+                row.update_record(**changes)
+                changed.append(values)
+    if new_rows:
+        table.bulk_insert(new_rows)
+        changed.extend(new_rows)
+    # remove records not uploaded anymore:
+    deleted = [row.id for matches in existing.values() for row in matches]
+    if deleted:
+        db(table.id.belongs(deleted)).delete()
+    return changed, len(deleted)
+
 @service.jsonrpc
 def save_project(project_name, defects, time_summaries, comments): 
+    "Store the project metrics (only changed rows), return the modifications"
     project_id = get_project_id(project_name)
+    try:
+        # defects are identified by uuid (the number can be changed),
+        # older versions don't send it (their rows are matched in order):
+        for defect in defects:
+            # JSON seems adding time ("2014-11-12 00:00:00"), remove it 
+            if ' ' in defect['date']:
+                defect['date'] = defect['date'].split(' ')[0]
+            if not defect.get('uuid'):
+                defect['uuid'] = None
+        key = ('uuid', )
+        changed_defects, deleted_defects = upsert_rows(db.psp_defect, 
+                                            project_id, defects, key)
+        # time summaries (one per phase):
+        changed_times, deleted_times = upsert_rows(db.psp_time_summary, 
+                                            project_id, time_summaries, 
+                                            ('phase', ))
+        # comments have no identifier (compare the whole message):
+        key = ('phase', 'message', 'delta')
+        changed_comments, deleted_comments = upsert_rows(db.psp_comment, 
+                                            project_id, comments, key)
+        # summarize the new data for the reports:
+        if changed_defects or changed_times or deleted_defects or deleted_times:
+            update_project_metrics(project_id)
+    except:
+        # do not leave the project half updated (the service traps errors)
+        db.rollback()
+        raise
+    db.commit()
 
-    # clean and store defects:
-    db(db.psp_defect.project_id==project_id).delete()
-    for defect in defects:
-        defect['project_id'] = project_id
-        defect.pop("id", None)
-        defect.pop("defect_id", None)
-        # JSON seems adding time ("2014-11-12 00:00:00"), remove it 
-        if ' ' in defect['date']:
-            defect['date'] = defect['date'].split(' ')[0]
-        db.psp_defect.insert(**defect)
-
-    # clean and store time summaries:
-    db(db.psp_time_summary.project_id==project_id).delete()
-    for time_summary in time_summaries:
-        time_summary['project_id'] = project_id
-        if 'id' in time_summary:
-             del time_summary['id']
-        db.psp_time_summary.insert(**time_summary)
-
-    # clean and store comments:
-    db(db.psp_comment.project_id==project_id).delete()
-    for comment in comments:
-        comment['project_id'] = project_id
-        if 'id' in comment:
-             del comment['id']
-        db.psp_comment.insert(**comment)
+    return {'defects': changed_defects, 
+            'time_summaries': changed_times,
+            'comments': changed_comments,
+            'deleted': deleted_defects + deleted_times + deleted_comments,
+           }
 
-    return True
+@service.jsonrpc
+def sync_project(project_name, defects, time_summaries, comments,
+                 actual_loc=None, reuse_library_entries=None):
+    "Store the project metrics and the postmortem data (in one call)"
+    changes = save_project(project_name, defects, time_summaries, comments)
+    if actual_loc is not None:
+        update_project(project_name, actual_loc, reuse_library_entries or [])
+    return changes
 
 @service.jsonrpc
 def load_project(project_name): 
@@ -73,12 +146,11 @@ def update_project(project_name, actual_loc, reuse_library_entries):
     project_id = get_project_id(project_name)
 
     # update total loc counted:
-    if project:
-        db(db.psp_project.project_id==project_id).update(actual_loc=actual_loc)
+    db(db.psp_project.project_id==project_id).update(actual_loc=actual_loc)
+    update_project_metrics(project_id)
 
     # clean and store reuse library entries:
-    if project:
-        db(db.psp_reuse_library.project_id==project_id).delete()
+    db(db.psp_reuse_library.project_id==project_id).delete()
     for entry in reuse_library_entries:
         entry['project_id'] = project_id
         db.psp_reuse_library.insert(**entry)
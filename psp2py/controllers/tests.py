@@ -1,6 +1,7 @@
 # coding: utf8
 
-from statistics import calc_correlation, calc_significance, calc_linear_regression, calc_student_t_probability
+from statistics import calc_correlation, calc_significance, calc_linear_regression, calc_student_t_probability, calc_double_sided_student_t_value
+from integration import f_student_t_distribution, simpson_rule_integrate
 
 # test TABLE A12 [HUMPHREY95] p.514
 x_values = [186, 699, 132, 272, 291, 331, 199, 1890, 788, 1601]
@@ -19,3 +20,17 @@ def significance():
     t, r2, n = calc_significance(x_values, y_values)
     p = calc_student_t_probability(t, n-1)
     return {'loc': x_values, 'hours': y_values, 'n': n, 'r2': r2, 't': t, 'ok': round(t, 4)==9.0335, 'p': p}
+
+def student_t():
+    # closed form (incomplete beta) vs numerical integration (reference)
+    inf = float("infinity")
+    rows = []
+    for t, n in [(9.0335, 9), (1.5, 5), (-0.5, 30)]:
+        p = calc_student_t_probability(t, n)
+        ref = simpson_rule_integrate(f_student_t_distribution(n), -inf, t)
+        rows.append((t, n, p, ref))
+    # 70% prediction interval, 8 degrees of freedom [HUMPHREY95] p.516
+    t = calc_double_sided_student_t_value(1 - 0.7, 8)
+    return {'rows': rows, 't': t, 
+            'ok': all([abs(p - ref) < 0.00001 for x, n, p, ref in rows]) and 
+                  round(t, 3)==1.108}
@@ -109,3 +109,92 @@ db.define_table("psp_reuse_library",
     Field("lineno", "integer"),
     Field("loc", "integer"),
     )
+
+
+# Materialized metrics (summarized per project when its data is uploaded),
+# so the reports and estimates don't need to scan the whole history:
+
+db.define_table("psp_project_metrics",
+    Field("id", "id"),
+    Field("project_id", db.psp_project, unique=True),
+    Field("planned_loc", "integer"),
+    Field("actual_loc", "integer"),
+    Field("plan", "integer", default=0),
+    Field("actual", "integer", default=0),
+    Field("interruption", "integer", default=0),
+    Field("defects", "integer", default=0),
+    Field("fix_time", "integer", default=0),
+    # times per phase (i.e. "plan_design", "actual_code", etc.):
+    *[Field("%s_%s" % (time, phase), "integer", default=0)
+      for time in PSP_TIMES for phase in PSP_PHASES]
+    )
+
+db.define_table("psp_defect_metrics",
+    Field("id", "id"),
+    Field("project_id", db.psp_project),
+    Field("type", "string"),
+    Field("inject_phase", "string"),
+    Field("remove_phase", "string"),
+    Field("quantity", "integer", default=0),
+    Field("fix_time", "integer", default=0),
+    )
+
+
+def update_project_metrics(project_id):
+    "Summarize sizes, times and defects of a project (materialized metrics)"
+    project = db(db.psp_project.project_id==project_id).select().first()
+    if not project:
+        return      # deleted (its metrics are removed on cascade)
+    metrics = {'planned_loc': project.planned_loc,
+               'actual_loc': project.actual_loc,
+               'defects': 0, 'fix_time': 0}
+    for time in PSP_TIMES:
+        metrics[time] = 0
+        for phase in PSP_PHASES:
+            metrics["%s_%s" % (time, phase)] = 0
+    # accumulate times (total and per phase)
+    rows = db(db.psp_time_summary.project_id==project_id).select()
+    for row in rows:
+        for time in PSP_TIMES:
+            metrics[time] += row[time] or 0
+            if row.phase in PSP_PHASES:
+                metrics["%s_%s" % (time, row.phase)] += row[time] or 0
+    # summarize defects per type and phases (replacing previous values)
+    db(db.psp_defect_metrics.project_id==project_id).delete()
+    q = db.psp_defect.project_id==project_id
+    q &= db.psp_defect.remove_phase != ''     # ignore won't fix defects
+    rows = db(q).select(
+            db.psp_defect.id.count().with_alias("quantity"),
+            db.psp_defect.fix_time.sum().with_alias("subtotal_fix_time"),
+            db.psp_defect.type,
+            db.psp_defect.inject_phase,
+            db.psp_defect.remove_phase,
+            groupby=(db.psp_defect.type,
+                     db.psp_defect.inject_phase,
+                     db.psp_defect.remove_phase,))
+    for row in rows:
+        db.psp_defect_metrics.insert(project_id=project_id,
+                                     type=row.psp_defect.type,
+                                     inject_phase=row.psp_defect.inject_phase,
+                                     remove_phase=row.psp_defect.remove_phase,
+                                     quantity=row.quantity,
+                                     fix_time=row.subtotal_fix_time or 0)
+        metrics['defects'] += row.quantity
+        metrics['fix_time'] += row.subtotal_fix_time or 0
+    db.psp_project_metrics.update_or_insert(
+            db.psp_project_metrics.project_id==project_id,
+            project_id=project_id, **metrics)
+
+def backfill_projects_metrics():
+    "Summarize historical projects whose metrics were not materialized yet"
+    materialized = db(db.psp_project_metrics.id>0)._select(
+                                        db.psp_project_metrics.project_id)
+    q = ~db.psp_project.project_id.belongs(materialized)
+    for row in db(q).select(db.psp_project.project_id):
+        update_project_metrics(row.project_id)
+    return True
+
+def build_projects_metrics():
+    "Backfill the missing metrics only once (new projects are kept updated)"
+    cache.ram("psp_projects_metrics", backfill_projects_metrics,
+              time_expire=None)
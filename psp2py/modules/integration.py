@@ -1,6 +1,17 @@
 #!/usr/bin/env python
 
-from math import e, pi, sqrt
+from math import e, exp, lgamma, pi, sqrt
+
+# numpy is optional (only used to evaluate the integrand over many points)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY_THRESHOLD = 1000      # minimum number of points to use numpy
+CACHE_SIZE = 1000           # normalization constants kept (degrees of freedom)
+
+t_constants = {}            # cache: {degrees of freedom: t constant}
 
 
 def compute_integral(f, x_low, x_high, w, n):
@@ -19,52 +30,117 @@ def compute_integral(f, x_low, x_high, w, n):
     return y
 
 
-def simpson_rule_integrate(f, x_low, x_high, error=0.00001):
-    # 1. identify the upper and lower limits of the numerical integration
+def sum_samples(f, x_low, w, first, n, step=2):
+    "Sum f(x_low + j * w) for j in range(first, n, step) (numpy if possible)"
+    if numpy is not None and (n - first) / step >= NUMPY_THRESHOLD:
+        x = x_low + numpy.arange(first, n, step) * w
+        try:
+            y = f(x)
+        except (TypeError, ValueError):
+            pass        # f doesn't support arrays (i.e. uses math module)
+        else:
+            if numpy.shape(y) == x.shape:
+                return float(y.sum())
+    total = 0
+    for j in xrange(first, n, step):
+        total += f(x_low + j * w)
+    return total
+
+
+def normalize_limits(x_low, x_high):
+    "Correct the integration range for symmetrical normalized functions"
+    # returns the new limits and the area to add (p >= 0) or subtract (p < 0)
     if x_high < 0 and x_low == float("-infinity"):
-        x_high = abs(x_high)
-        x_low = 0
-        p = -0.5
+        return 0, abs(x_high), -0.5
     elif x_low == float("-infinity"):
-        x_low = 0
-        p = 0.5
-    else:
-        p = 0
+        return 0, x_high, 0.5
+    elif x_low > 0 and x_high == float("infinity"):
+        return 0, x_low, -0.5
+    return x_low, x_high, 0
+
+
+def simpson_rule_integrate(f, x_low, x_high, error=0.00001):
+    # 1. identify the upper and lower limits of the numerical integration
+    x_low, x_high, p = normalize_limits(x_low, x_high)
     # 2. select an initial number N and old result
     n = 20
     old_y = 0
-    while True:
-        # 3. divide the range to get the segment width
-        w = (x_high - x_low) / n
-        # 4. compute the numerical integration approximation
-        y = compute_integral(f, x_low, x_high, w, n)
-        # 5. compare with the old result if error is permisible
-        if abs(y - old_y) <= error:
-            if p >= 0:
-                return p + y
-            else:
-                return - p - y
+    # 3. divide the range to get the segment width
+    w = (x_high - x_low) / float(n)
+    # 4. compute the numerical integration approximation (keeping the sums)
+    ends = f(x_low) + f(x_high)
+    odd = sum_samples(f, x_low, w, 1, n)        # weight 4
+    even = sum_samples(f, x_low, w, 2, n)       # weight 2
+    y = w / 3.0 * (ends + 4 * odd + 2 * even)
+    # 5. compare with the old result if error is permisible
+    while abs(y - old_y) > error:
         old_y = y
-        # 6. double N
+        # 6. double N: the previous points are the even ones now, so only
+        #    the new midpoints (odd) have to be evaluated
+        even += odd
         n = 2 * n
+        w = w / 2
+        odd = sum_samples(f, x_low, w, 1, n)
+        y = w / 3.0 * (ends + 4 * odd + 2 * even)
         # 7. repeat ...
+    if p >= 0:
+        return p + y
+    else:
+        return - p - y
 
 
-def factorial(x, step=1):
-    "Calculate integer or float factorial (for gamma function, step=2)"
-    if x > step:
-        return x * factorial(x - step, step) / step
-    return x / step
+def adaptive_simpson_integrate(f, x_low, x_high, error=0.00001, 
+                               max_depth=50):
+    "Integrate refining only the subintervals that don't meet their error"
+    x_low, x_high, p = normalize_limits(x_low, x_high)
+    f_low, f_high = f(x_low), f(x_high)
+    x_mid = (x_low + x_high) / 2.0
+    f_mid = f(x_mid)
+    whole = (x_high - x_low) / 6.0 * (f_low + 4 * f_mid + f_high)
+    y = adaptive_simpson_step(f, x_low, x_high, f_low, f_mid, f_high, whole, 
+                              error, max_depth)
+    if p >= 0:
+        return p + y
+    else:
+        return - p - y
+
+
+def adaptive_simpson_step(f, a, b, fa, fm, fb, whole, error, depth):
+    "Recursive step: split [a, b] and check the error budget of each half"
+    m = (a + b) / 2.0
+    lm, rm = (a + m) / 2.0, (m + b) / 2.0
+    flm, frm = f(lm), f(rm)
+    left = (m - a) / 6.0 * (fa + 4 * flm + fm)
+    right = (b - m) / 6.0 * (fm + 4 * frm + fb)
+    delta = left + right - whole
+    if depth <= 0 or abs(delta) <= 15 * error:
+        return left + right + delta / 15.0     # richardson extrapolation
+    # each half has to meet half of the error budget:
+    return (adaptive_simpson_step(f, a, m, fa, flm, fm, left, error / 2.0, 
+                                  depth - 1) + 
+            adaptive_simpson_step(f, m, b, fm, frm, fb, right, error / 2.0, 
+                                  depth - 1))
 
 
 def gamma(n, d=2):
     "Calculate gamma function value for a fraction (numerator & denominator)"
-    # WARNING: only tested for d=2 !
-    if n % 2 != 0 and d == 2:
-        return factorial(n - 2, step=2.0) * sqrt(pi)
-    else:
-        i = n / d
-        return factorial(i - 1)
+    return exp(lgamma(n / float(d)))
+
+
+def student_t_constant(n):
+    "Calculate the normalization constant of the t distribution (n dof)"
+    # dict get/set are atomic (web2py threads): at worst it is computed twice
+    try:
+        return t_constants[n]
+    except KeyError:
+        pass
+    # gamma((n + 1) / 2) / (sqrt(n * pi) * gamma(n / 2)) using logarithms,
+    # so it is stable for any degrees of freedom (the gammas would overflow)
+    k = exp(lgamma((n + 1) / 2.0) - lgamma(n / 2.0)) / sqrt(n * pi)
+    if len(t_constants) >= CACHE_SIZE:
+        t_constants.clear()
+    t_constants[n] = k
+    return k
 
 
 def f_normal_distribution(u):
@@ -74,5 +150,54 @@ def f_normal_distribution(u):
 def f_student_t_distribution(n):
     # student t distribution
     # n = degrees of freedom
-    k = gamma(n + 1, 2) / (sqrt(n*pi) * gamma(n, 2))
+    k = student_t_constant(n)
     return lambda u: k * (1 + (u ** 2) / float(n)) ** (- (n +1) / 2.0)
+
+
+def benchmark():
+    "Compare the integrand evaluations needed by each integration method"
+
+    class Counter(object):
+        "Wrap the integrand to count the evaluations (of scalars or arrays)"
+        def __init__(self, f):
+            self.f = f
+            self.calls = 0
+        def __call__(self, x):
+            self.calls += 1
+            return self.f(x)
+
+    def doubling_integrate(f, x_low, x_high, error=0.00001):
+        "Previous method: evaluate every point again each time N is doubled"
+        x_low, x_high, p = normalize_limits(x_low, x_high)
+        n = 20
+        old_y = 0
+        while True:
+            y = compute_integral(f, x_low, x_high, (x_high - x_low) / float(n), n)
+            if abs(y - old_y) <= error:
+                return p + y if p >= 0 else - p - y
+            old_y = y
+            n = 2 * n
+
+    inf = float("infinity")
+    tests = [("normal(-inf, -1.1)", f_normal_distribution, -inf, -1.1),
+             ("normal(-inf, 2.5)", f_normal_distribution, -inf, 2.5),
+             ("student t 9 (-inf, 1.1)", f_student_t_distribution(9), -inf, 1.1),
+             ("student t 4 (2.132, inf)", f_student_t_distribution(4), 2.132, inf),
+             ("x ** 4 (0, 10)", lambda x: x ** 4, 0, 10),
+            ]
+    methods = [("doubling", doubling_integrate), 
+               ("refining", simpson_rule_integrate), 
+               ("adaptive", adaptive_simpson_integrate)]
+    print "%-26s" % "integral", 
+    print " ".join(["%20s" % name for name, method in methods])
+    for name, f, x_low, x_high in tests:
+        print "%-26s" % name, 
+        for method_name, method in methods:
+            counter = Counter(f)
+            y = method(counter, x_low, x_high)
+            print "%10.6f (%6d)" % (y, counter.calls),
+        print
+
+
+if __name__ == "__main__":
+    benchmark()
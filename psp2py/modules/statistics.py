@@ -2,7 +2,18 @@
 # coding: utf8
 
 import math
-from integration import f_student_t_distribution, simpson_rule_integrate
+from integration import student_t_constant
+
+# numpy is optional (only used to speed up the sums of large series)
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+NUMPY_THRESHOLD = 1000      # minimum series length to use numpy
+
+EPSILON = 1e-15             # relative precision for the continued fraction
+TINY = 1e-300               # avoid divisions by zero (Lentz's method)
 
 
 def mean(values):
@@ -10,46 +21,115 @@ def mean(values):
     return sum(values) / float(len(values))
     
 
-def calc_correlation(x_values, y_values):
-    "Calculate strength of a relationship between two sets of data"
-    # calculate aux variables
-    n = len(x_values)       
-    sum_xy = sum([(x_values[i] * y_values[i]) for i in range(n)])
-    sum_x = sum([(x_values[i]) for i in range(n)])
-    sum_y = sum([(y_values[i]) for i in range(n)])
-    sum_x2 = sum([(x_values[i] ** 2) for i in range(n)])
-    sum_y2 = sum([(y_values[i] ** 2) for i in range(n)])
+class RegressionStats(object):
+    "Accumulate the sums of two sets of data (single pass) for the estimates"
+
+    def __init__(self, x_values=(), y_values=()):
+        self.n = 0
+        self.sum_x = self.sum_y = 0.0
+        self.sum_xy = self.sum_x2 = self.sum_y2 = 0.0
+        self.extend(x_values, y_values)
+
+    def add(self, x, y):
+        "Account a new pair of values"
+        self.n += 1
+        self.sum_x += x
+        self.sum_y += y
+        self.sum_xy += x * y
+        self.sum_x2 += x * x
+        self.sum_y2 += y * y
+
+    def extend(self, x_values, y_values):
+        "Account the pairs of values of the two sets of data"
+        if numpy is not None and len(x_values) >= NUMPY_THRESHOLD:
+            x = numpy.asarray(x_values, dtype=float)
+            y = numpy.asarray(y_values, dtype=float)
+            self.n += len(x)
+            self.sum_x += float(x.sum())
+            self.sum_y += float(y.sum())
+            self.sum_xy += float(numpy.dot(x, y))
+            self.sum_x2 += float(numpy.dot(x, x))
+            self.sum_y2 += float(numpy.dot(y, y))
+            return
+        n, sum_x, sum_y = self.n, self.sum_x, self.sum_y
+        sum_xy, sum_x2, sum_y2 = self.sum_xy, self.sum_x2, self.sum_y2
+        for x, y in zip(x_values, y_values):
+            n += 1
+            sum_x += x
+            sum_y += y
+            sum_xy += x * y
+            sum_x2 += x * x
+            sum_y2 += y * y
+        self.n, self.sum_x, self.sum_y = n, sum_x, sum_y
+        self.sum_xy, self.sum_x2, self.sum_y2 = sum_xy, sum_x2, sum_y2
+
+    def mean(self):
+        "Return the averages of both sets of data"
+        return self.sum_x / self.n, self.sum_y / self.n
+
+    def correlation(self):
+        "Calculate strength of a relationship between two sets of data"
+        n, sum_x, sum_y = self.n, self.sum_x, self.sum_y
+        return ((n * self.sum_xy - (sum_x * sum_y)) / 
+                math.sqrt((n * self.sum_x2 - sum_x ** 2) * 
+                          (n * self.sum_y2 - sum_y ** 2)))
+
+    def significance(self):
+        "Calculate the significance (likelihood of the data correlation)"
+        n = self.n
+        r = self.correlation()
+        r2 = r**2
+        t = abs(r)*math.sqrt(n - 2)/math.sqrt(1 - r**2)
+        return t, r2, n
+
+    def linear_regression(self):
+        "Calculate the linear regression parameters (b0, b1)"
+        n = self.n
+        x_avg, y_avg = self.mean()
+        b1 = (self.sum_xy - (n * x_avg * y_avg)) / (self.sum_x2 - n * (x_avg ** 2))
+        b0 = y_avg - b1 * x_avg
+        return (b0, b1)
+
+    def variance(self, b0=None, b1=None):
+        "Calculate the mean square deviation of the linear regeression line"
+        if b0 is None or b1 is None:
+            b0, b1 = self.linear_regression()
+        # expanded sum((y - b0 - b1 * x) ** 2) (no need to walk the data)
+        sum_aux = (self.sum_y2 + self.n * b0 ** 2 + b1 ** 2 * self.sum_x2 
+                   - 2 * b0 * self.sum_y - 2 * b1 * self.sum_xy 
+                   + 2 * b0 * b1 * self.sum_x)
+        return max(sum_aux, 0.0) / (self.n - 2.0)
+
+    def prediction_interval(self, x_k, y_k, alpha):
+        "Calculate the regression and the upper and lower prediction interval"
+        n = self.n
+        x_avg, y_avg = self.mean()
+        b0, b1 = self.linear_regression()
+        # calculate the t-value for the given alpha p-value
+        t = calc_double_sided_student_t_value(1 - alpha, n - 2)
+        # calculate the standard deviation
+        sigma = math.sqrt(self.variance(b0, b1))
+        # calculate the range (sum((x - x_avg) ** 2) expanded)
+        sum_xi_xavg = self.sum_x2 - n * x_avg ** 2
+        aux = 1 + (1 / float(n)) + ((x_k - x_avg) ** 2) / sum_xi_xavg
+        p_range = t * sigma * math.sqrt(aux)
+        # combine the range with the x_k projection:
+        return b0, b1, p_range, y_k + p_range, y_k - p_range, t
 
-    # calculate corelation
-    r = (n * sum_xy - (sum_x * sum_y)) / math.sqrt((n * sum_x2 - sum_x ** 2) * (n * sum_y2 - sum_y ** 2))
 
-    return r
+def calc_correlation(x_values, y_values):
+    "Calculate strength of a relationship between two sets of data"
+    return RegressionStats(x_values, y_values).correlation()
 
 
 def calc_significance(x_values, y_values):
     "Calculate the significance (likelihood of two set of data correlation)"
-    n = len (x_values)
-    r = calc_correlation(x_values, y_values)
-    r2 = r**2
-    t = abs(r)*math.sqrt(n - 2)/math.sqrt(1 - r**2)
-    return t, r2, n
+    return RegressionStats(x_values, y_values).significance()
 
 
 def calc_linear_regression(x_values, y_values):
     "Calculate the linear regression parameters for a set of n values"
-
-    # calculate aux variables
-    x_avg = mean(x_values)
-    y_avg = mean(y_values)
-    n = len(x_values)
-    sum_xy = sum([(x_values[i] * y_values[i]) for i in range(n)])
-    sum_x2 = sum([(x_values[i] ** 2) for i in range(n)])
-
-    # calculate regression coefficients
-    b1 = (sum_xy - (n * x_avg * y_avg)) / (sum_x2 - n * (x_avg ** 2))
-    b0 = y_avg - b1 * x_avg
-
-    return (b0, b1)
+    return RegressionStats(x_values, y_values).linear_regression()
 
 
 def calc_standard_deviation(values):
@@ -60,40 +140,97 @@ def calc_standard_deviation(values):
                           for x_i in values]) / float(n))
     return sd, x_avg                      
 
+def incomplete_beta(a, b, x):
+    "Calculate the regularized incomplete beta function I_x(a, b)"
+    if x <= 0:
+        return 0.0
+    if x >= 1:
+        return 1.0
+    # the continued fraction converges fast only for x < (a + 1) / (a + b + 2)
+    if x > (a + 1.0) / (a + b + 2.0):
+        return 1.0 - incomplete_beta(b, a, 1.0 - x)
+    ln_front = (math.lgamma(a + b) - math.lgamma(a) - math.lgamma(b) +
+                a * math.log(x) + b * math.log(1.0 - x))
+    return math.exp(ln_front) * beta_continued_fraction(a, b, x) / a
+
+
+def beta_continued_fraction(a, b, x, max_iter=300):
+    "Evaluate the continued fraction of the incomplete beta (modified Lentz)"
+    c = 1.0
+    d = 1.0 - (a + b) * x / (a + 1.0)
+    d = 1.0 / (d if abs(d) > TINY else TINY)
+    h = d
+    for m in xrange(1, max_iter + 1):
+        # even step:
+        aa = m * (b - m) * x / ((a - 1.0 + 2 * m) * (a + 2 * m))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > TINY else TINY)
+        c = 1.0 + aa / c
+        c = c if abs(c) > TINY else TINY
+        h *= d * c
+        # odd step:
+        aa = -(a + m) * (a + b + m) * x / ((a + 2 * m) * (a + 1.0 + 2 * m))
+        d = 1.0 + aa * d
+        d = 1.0 / (d if abs(d) > TINY else TINY)
+        c = 1.0 + aa / c
+        c = c if abs(c) > TINY else TINY
+        delta = d * c
+        h *= delta
+        if abs(delta - 1.0) < EPSILON:
+            break
+    return h
+
+
 def calc_student_t_probability(x, n):
     "Integrate t distribution from -infinity to x with n degrees of freedom"
-    inf = float("infinity")
-    p = simpson_rule_integrate(f_student_t_distribution(n), -inf, x)
-    return p
+    # closed form: the tail area is given by the incomplete beta function
+    tail = 0.5 * incomplete_beta(n / 2.0, 0.5, n / (n + float(x) ** 2))
+    if x > 0:
+        return 1.0 - tail
+    return tail
 
 def calc_double_sided_student_t_probability(t, n):
     "Calculate the p-value using a double sided student t distribution"
-    # integrate a finite area from the origin to t
-    p_aux = simpson_rule_integrate(f_student_t_distribution(n), 0, t)
     # return the area of the two tails of the distribution (symmetrical)
-    return (0.5 - p_aux) * 2
+    return incomplete_beta(n / 2.0, 0.5, n / (n + float(t) ** 2))
+
+def calc_student_t_density(t, n):
+    "Calculate the t distribution probability density function"
+    k = student_t_constant(n)
+    return k * (1 + t ** 2 / float(n)) ** (-(n + 1) / 2.0)
+
+# memo of the t-values already calculated: {(p, n): t}
+t_values = {}
 
 def calc_double_sided_student_t_value(p, n):
     "Calculate the t-value using a double sided student t distribution"
-    # replaces table lookup, thanks to http://statpages.org/pdfs.html
-    v = dv = 0.5
-    t = 0
-    while dv > 0.000001:
-        t = 1 / v - 1
-        dv = dv / 2
-        if calc_double_sided_student_t_probability(t, n) > p:
-            v = v - dv
+    key = (p, n)
+    if key in t_values:
+        return t_values[key]
+    # newton's method (the derivative of the two tails area is -2 * density)
+    # falling back to bisection if the step goes out of the bracket
+    low, high = 0.0, None
+    t = 1.0
+    for i in xrange(100):
+        error = calc_double_sided_student_t_probability(t, n) - p
+        if error > 0:
+            low = t
         else:
-            v = v + dv
-    return t
+            high = t
+        new_t = t + error / (2 * calc_student_t_density(t, n))
+        if new_t <= low or high is not None and new_t >= high:
+            new_t = (low + high) / 2.0 if high is not None else t * 2
+        if abs(new_t - t) <= 1e-12 * t:
+            break
+        t = new_t
+    t_values[key] = new_t
+    return new_t
 
 
 def calc_variance(x_values, y_values, b0, b1):
     "Calculate the mean square deviation of the linear regeression line"
     # take the variance from the regression line instead of the data average
-    sum_aux = sum([(y - b0 - b1 * x) ** 2 for x, y in zip(x_values, y_values)])
-    n = float(len(x_values))
-    return (1 / (n - 2.0)) * sum_aux
+    return RegressionStats(x_values, y_values).variance(b0, b1)
 
 
 def calc_prediction_interval(x_values, y_values, x_k, y_k, alpha):
@@ -101,28 +238,5 @@ def calc_prediction_interval(x_values, y_values, x_k, y_k, alpha):
        then calculate the upper and lower prediction interval
 
     """
-
-    # calculate aux variables
-    x_avg = mean(x_values)
-    y_avg = mean(y_values)
-    n = len(x_values)
-    sum_xy = sum([(x_values[i] * y_values[i]) for i in range(n)])
-    sum_x2 = sum([(x_values[i] ** 2) for i in range(n)])
-
-    # calculate regression coefficients
-    b1 = (sum_xy - (n * x_avg * y_avg)) / (sum_x2 - n * (x_avg ** 2))
-    b0 = y_avg - b1 * x_avg
-
-    # calculate the t-value for the given alpha p-value
-    t = calc_double_sided_student_t_value(1 - alpha, n - 2)
-
-    # calculate the standard deviation
-    sigma = math.sqrt(calc_variance(x_values, y_values, b0, b1))
-
-    # calculate the range
-    sum_xi_xavg = sum([(x - x_avg) ** 2 for x in x_values], 0.0)
-    aux = 1 + (1 / float(n)) + ((x_k - x_avg) ** 2) / sum_xi_xavg
-    p_range = t * sigma * math.sqrt(aux)
-
-    # combine the range with the x_k projection:
-    return b0, b1, p_range, y_k + p_range, y_k - p_range, t
+    stats = RegressionStats(x_values, y_values)
+    return stats.prediction_interval(x_k, y_k, alpha)